@@ -49,6 +49,10 @@ setup(name='transmogrify.htmlcontentextractor',
       include_package_data=True,
       zip_safe=False,
       install_requires=install_requires,
+      extras_require={
+        # faster block alignment in the clustering
+        'numpy': ['numpy'],
+        },
       entry_points="""
             [z3c.autoinclude.plugin]
             target = transmogrify
@@ -8,17 +8,27 @@ from collective.transmogrifier.utils import Matcher
 from collective.transmogrifier.utils import Condition
 
 
-from webstemmer.analyze import PageFeeder, LayoutAnalyzer, LayoutCluster
+from webstemmer.analyze import PageFeeder, LayoutAnalyzer, LayoutCluster, Progress
 from webstemmer.extract import TextExtractor, LayoutPatternSet, LayoutPattern
-from webstemmer.layoutils import sigchars, get_textblocks, retrieve_blocks, WEBSTEMMER_VERSION, KEY_ATTRS
+from webstemmer.layoutils import sigchars, get_textblocks, retrieve_block_ids, WEBSTEMMER_VERSION, KEY_ATTRS
 from webstemmer.zipdb import ACLDB
-from webstemmer.htmldom import parse
+from webstemmer.textcrawler import wash_url
+from webstemmer.htmldom import parse as htmldom_parse
 from lxml import etree
 import lxml.html
 import lxml.html.soupparser
 
 from StringIO import StringIO
 from sys import stderr
+from urlparse import urljoin
+import os
+import hashlib
+import json
+import time
+import tempfile
+import cPickle
+from collections import deque
+from transmogrify.htmlcontentextractor import metrics as metricutils
 
 import logging
 
@@ -53,6 +63,43 @@ condition
 debug
   default is ''
 
+sample
+  default 0. If set, only the first this many pages are clustered to find the layouts. Those pages are
+  then released and every later page is matched against the layouts and passed on straight away.
+  With 0 every page is read in and clustered first.
+
+diff_error
+  default 0.05. Clusters with many pages are scored by comparing a sample of page pairs, accurate to
+  within this error. 0 compares every pair.
+
+patterns
+  file to keep the learnt layouts in between runs. If it holds layouts learnt for the same site
+  and settings they are used and no pages are clustered. Otherwise the layouts are learnt and saved
+  to it. It can also be the output of webstemmer's analyze.py, which is always used. Its layouts were
+  learnt from webstemmer's own parser so pages are also parsed with it to match them.
+
+patterns_version
+  default ''. Saved layouts are only used for the same version, change it when the site's
+  templates change.
+
+buffer
+  default 0, every item is kept in memory while pages are read in for clustering. Otherwise the
+  number of items kept in memory, later items are written to a temporary file and read back when
+  they're extracted so only the text blocks of each page need to fit in memory. Items read back
+  are copies, so sections before this one that hold on to items won't see changes made to them
+  afterwards, and the other way round. Items that can't be pickled are kept in memory.
+
+buffer_dir
+  directory for the temporary file, the system's temporary directory by default.
+
+metrics
+  file to write the section's timings and counters to once it has passed on its last item. They are
+  also kept in the section's `metrics` dict: parse, chunk, cluster, identify and serialize times,
+  page pairs compared and pruned while clustering, and the pages extracted and failed.
+
+metrics_format
+  default 'json'. 'prometheus' writes the metrics in Prometheus' text format instead.
+
 """
 
 
@@ -62,7 +109,7 @@ def match_blocks(self, blocks0, strict=True):
     mains = [ m for (d,m,p) in self.pattern ]
     paths = [ p for (d,m,p) in self.pattern ]
     layout = []
-    for (diffscore,mainscore,blocks1,path) in zip(diffs, mains, retrieve_blocks(paths, blocks0), paths):
+    for (diffscore,mainscore,blocks1,path) in zip(diffs, mains, retrieve_block_ids(self.pathids, blocks0), paths):
       if strict and not blocks1:
         return None
       layout.append(LayoutSection(len(layout), diffscore, mainscore, blocks1, path))
@@ -133,6 +180,60 @@ def toXPath(pat):
 
 default_charset='utf-8'
 
+# bump when the saved patterns change
+PATTERNS_FORMAT = 1
+
+
+class ItemBuffer(object):
+    """Items in the order they were added. If keep is set, items after the
+    first `keep` are pickled to a temporary file rather than kept in memory,
+    apart from any that can't be pickled, and come back out as copies.
+    Iterating takes the items out."""
+
+    def __init__(self, keep=0, dir=None):
+        self.keep = keep
+        self.dir = dir
+        self.head = deque()
+        self.file = None
+        self.spilled = 0
+        # position in the file -> item that couldn't be pickled
+        self.unpickled = {}
+
+    def __len__(self):
+        return len(self.head) + self.spilled
+
+    def append(self, item):
+        if not self.keep or len(self.head) < self.keep:
+            self.head.append(item)
+            return
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix='autofinder', dir=self.dir)
+        try:
+            data = cPickle.dumps(item, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # anything in an item can fail to pickle, it stays in memory.
+            # None marks its place in the file
+            self.unpickled[self.spilled] = item
+            data = cPickle.dumps(None, cPickle.HIGHEST_PROTOCOL)
+        self.file.write(data)
+        self.spilled += 1
+
+    def __iter__(self):
+        while self.head:
+            yield self.head.popleft()
+        if self.file is None:
+            return
+        self.file.seek(0)
+        for n in xrange(self.spilled):
+            item = cPickle.load(self.file)
+            if item is None:
+                item = self.unpickled.pop(n)
+            yield item
+        self.file.close()
+        self.file = None
+        self.spilled = 0
+
+
 class AutoFinder(object):
     classProvides(ISectionBlueprint)
     implements(ISection)
@@ -147,6 +248,19 @@ class AutoFinder(object):
         self.condition = Condition(options.get('condition', 'python:True'),
                                    transmogrifier, name, options)
         self.log = logging.getLogger(name)
+        self.sample = int(options.get('sample', '0'))
+        # large clusters are scored from a sample of page pairs, 0 compares them all
+        self.diff_error = float(options.get('diff_error', '0.05'))
+        self.patterns = options.get('patterns', '').strip()
+        self.patterns_version = options.get('patterns_version', '')
+        self.buffer = int(options.get('buffer', '0'))
+        self.buffer_dir = options.get('buffer_dir', '').strip() or None
+        self.fingerprint = None
+        # set when the patterns come from analyze.py
+        self.htmldom_patterns = False
+        self.metrics_file = options.get('metrics', '').strip()
+        self.metrics_format = options.get('metrics_format', 'json').strip().lower()
+        self.metrics = {}
 
 
     def __iter__(self):
@@ -155,52 +269,207 @@ class AutoFinder(object):
         mangle_pat = None
         linkinfo = 'linkinfo'
         #
-        analyzer = LayoutAnalyzer(debug=debug)
+        # the blocks' text isn't needed once the pages are clustered. Progress
+        # is logged every 30 seconds rather than for every page
+        analyzer = LayoutAnalyzer(debug=debug, keep_text=False, diff_error=self.diff_error,
+                                  progress=Progress(self.log.info, interval=30.0))
         if mangle_pat:
             analyzer.set_encoder(mangle_pat)
 
         feeder = PageFeeder(analyzer, linkinfo=linkinfo, acldb=None,
                                 default_charset=default_charset, debug=debug)
 
-        items = []
+        items = ItemBuffer(self.buffer, self.buffer_dir)
+        patternset = None
+        self.metrics = {}
         for item in previous:
+            metricutils.count(self.metrics, 'items')
             content = self.getHtml(item)
+            if self.patterns and self.fingerprint is None and content is not None \
+                    and not self.disable:
+                # layouts saved by an earlier run mean nothing needs clustering
+                patternset = self.load(item['_site_url'], cluster_threshold, title_threshold,
+                                       score_threshold, self.diff_error, mangle_pat)
+                if patternset is not None:
+                    analyzer = feeder = None
             if self.disable or not self.condition(item):
                 yield item
             elif item.get('_template'):
                 yield item
-            elif content is not None:
-                feeder.feed_page(item['_site_url'] + item['_path'], content)
-                items.append(item)
-            else:
+            elif content is None:
                 yield item
-            feeder.close()
+            elif patternset is not None:
+                # the patterns are fixed so pages are classified as they come
+                if self.extract(patternset, item) is not None:
+                    yield item
+            else:
+                name = item['_site_url'] + item['_path']
+                tree = self.parse(content)
+                start = time.time()
+                feeder.feed_tree(name, tree)
+                # link text helps pick out the title section of pages
+                for (url, text) in self.anchors(name, tree, item['_site_url']):
+                    feeder.add_anchor(url, text)
+                metricutils.timed(self.metrics, 'chunk', start)
+                items.append(item)
+                if self.sample and len(items) >= self.sample:
+                    feeder.close()
+                    patternset = self.learn(analyzer, cluster_threshold, title_threshold,
+                                            score_threshold)
+                    # the sample isn't needed once the patterns are known
+                    analyzer = feeder = None
+                    sample, items = items, []
+                    for item in sample:
+                        if self.extract(patternset, item) is not None:
+                            yield item
+                    del sample
         if items:
-            self.clusters = {}
-            clusters = analyzer.analyze(cluster_threshold, title_threshold)
-            patternset = LayoutPatternSet()
-            patternset.pats = [c for c in clusters if c.pattern and score_threshold <= c.score]
-
+            feeder.close()
+            patternset = self.learn(analyzer, cluster_threshold, title_threshold,
+                                    score_threshold)
+        for item in items:
+            if self.extract(patternset, item) is not None:
+                yield item
+        if self.metrics_file:
+            metricutils.write(self.metrics, self.metrics_file, self.log.name, self.metrics_format)
+
+    def learn(self, analyzer, cluster_threshold, title_threshold, score_threshold):
+        """Cluster the pages fed to analyzer and return the LayoutPatternSet
+        of the clusters that scored well enough"""
+        self.clusters = {}
+        start = time.time()
+        clusters = analyzer.analyze(cluster_threshold, title_threshold)
+        metricutils.timed(self.metrics, 'cluster', start)
+        metricutils.count(self.metrics, 'pages_clustered', len(analyzer.pages))
+        metricutils.count(self.metrics, 'comparisons', analyzer.comparisons)
+        metricutils.count(self.metrics, 'pruned', analyzer.pruned)
+        patternset = LayoutPatternSet()
+        patternset.pats = [c for c in clusters if c.pattern and score_threshold <= c.score]
+        self.metrics['patterns'] = len(patternset.pats)
+        self.log.info("learnt %d patterns from %d pages", len(patternset.pats), len(analyzer.pages))
+        if self.patterns:
+            self.save(patternset)
+        return patternset
+
+    def load(self, site, *settings):
+        """Return the LayoutPatternSet saved in the patterns file if it was
+        learnt for this site and settings, otherwise None. A file that can't
+        be read is logged and learnt again."""
+        self.fingerprint = hashlib.sha1(json.dumps(
+            [PATTERNS_FORMAT, WEBSTEMMER_VERSION, site, self.patterns_version] + list(settings)
+            )).hexdigest()
+        if not os.path.exists(self.patterns):
+            return None
+        patternset = LayoutPatternSet()
+        with open(self.patterns) as fp:
+            data = fp.read()
+        try:
+            saved = json.loads(data)
+        except ValueError:
+            # output of webstemmer's analyze.py
+            try:
+                patternset.read(StringIO(data))
+            except (ValueError, SyntaxError, TypeError, re.error), e:
+                self.log.warning("can't read patterns from %s (%s), learning them again",
+                                 self.patterns, e)
+                return None
+            self.metrics['patterns'] = len(patternset.pats)
+            self.htmldom_patterns = True
+            self.log.info("read %d patterns from %s, learnt by analyze.py so pages are chunked "
+                          "with htmldom to match them", len(patternset.pats), self.patterns)
+            return patternset
+        if not isinstance(saved, dict) or saved.get('fingerprint') != self.fingerprint:
+            self.log.info("patterns in %s are for another site or settings, learning them again",
+                          self.patterns)
+            return None
+        try:
+            if saved['mangle_pat']:
+                patternset.set_encoder(saved['mangle_pat'])
+            for pat in saved['patterns']:
+                pattern = [tuple(sect) for sect in pat['pattern']]
+                patternset.pats.append(LayoutPattern(pat['name'], pat['score'], pat['title_sectno'],
+                                                     pat['main_sectno'], pattern))
+        except (KeyError, TypeError, ValueError, AttributeError, re.error), e:
+            self.log.warning("can't load patterns from %s (%r), learning them again",
+                             self.patterns, e)
+            return None
+        self.metrics['patterns'] = len(patternset.pats)
+        self.log.info("loaded %d patterns from %s", len(patternset.pats), self.patterns)
+        return patternset
+
+    def save(self, patternset):
+        """Save patternset to the patterns file as json"""
+        saved = dict(format=PATTERNS_FORMAT,
+                     fingerprint=self.fingerprint,
+                     mangle_pat=patternset.mangle_pat,
+                     patterns=[dict(name=pat.name, score=pat.score, title_sectno=pat.title_sectno,
+                                    main_sectno=pat.main_sectno, pattern=pat.pattern)
+                               for pat in patternset.pats])
+        # write then rename so an interrupted run doesn't leave half a file
+        tmp = self.patterns + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(saved, fp, indent=1, sort_keys=True)
+        os.rename(tmp, self.patterns)
+        self.log.info("saved %d patterns to %s", len(patternset.pats), self.patterns)
+
+    def extract(self, patternset, item):
+        """Update item with the fields of the layout it matches. Returns
+        None if the item should be dropped"""
         #default_charset='iso-8859-1'
         pat_threshold=0.8
         self.debug = 0
         strict=True
-        for item in items:
-            content = self.getHtml(item)
-            name = item['_site_url'] + item['_path']
-            if name == 'linkinfo': continue
-            tree = parse(content, charset=default_charset)
-            (pat1, layout) = patternset.identify_layout(tree, pat_threshold, strict=strict)
-            etree = lxml.html.fromstring(content)
-            newfields = self.dump_text(name, pat1, layout, etree, item['_path'])
-            if newfields:
-                self.log.info("PASS: '%s', matched=%s", item.get('_path'), newfields.keys() )
-            else:
-                self.log.info("FAIL: '%s'", item.get('_path'))
-                
-            item.update( newfields )
-            yield item
+        content = self.getHtml(item)
+        name = item['_site_url'] + item['_path']
+        if name == 'linkinfo': return None
+        # the same tree is used to find the layout and extract from it
+        tree = self.parse(content)
+        start = time.time()
+        if self.htmldom_patterns:
+            # the paths analyze.py learnt are those of htmldom's blocks
+            layout_tree = htmldom_parse(content, charset=default_charset, styles=False)
+        else:
+            layout_tree = tree
+        (pat1, layout) = patternset.identify_layout(layout_tree, pat_threshold, strict=strict)
+        metricutils.timed(self.metrics, 'identify', start)
+        start = time.time()
+        newfields = self.dump_text(name, pat1, layout, tree, item['_path'])
+        metricutils.timed(self.metrics, 'serialize', start)
+        if newfields:
+            metricutils.count(self.metrics, 'extracted')
+            self.log.info("PASS: '%s', matched=%s", item.get('_path'), newfields.keys() )
+        else:
+            metricutils.count(self.metrics, 'failed')
+            self.log.info("FAIL: '%s'", item.get('_path'))
+
+        item.update( newfields )
+        return item
+
 
+    def anchors(self, url, tree, site_url):
+        """Yield (url, text) for each link on the page at url to another page
+        under site_url. The links webstemmer's HTMLLinkFinder finds but from
+        the tree already parsed, leaving out mailto:, javascript: and the like,
+        links within the page and links off the site"""
+        base = tree.find('.//base')
+        if base is not None and base.get('href'):
+            url = urljoin(url, wash_url(base.get('href')))
+        for a in tree.iter('a', 'area'):
+            href = a.get('href')
+            if href is None or href.strip().startswith('#'):
+                continue
+            href = urljoin(url, wash_url(href))
+            if href.startswith(site_url) and href.split(':', 1)[0].lower() in ('http', 'https'):
+                yield href, a.text_content()
+
+    def parse(self, content):
+        """Parse with lxml. webstemmer makes the same text blocks from it as
+        from its own parser. Always a whole document so fragments don't get
+        a made up parent."""
+        start = time.time()
+        tree = lxml.html.document_fromstring(content)
+        metricutils.timed(self.metrics, 'parse', start)
+        return tree
 
     def getHtml(self, item):
               path = item.get('_path', None)
@@ -223,12 +492,14 @@ class AutoFinder(object):
         enc = lambda x: x.encode(codec_out, 'replace')
         if not layout:
           return {}
-        
-        if self.debug:
+        # the text dump is only for the debug log so don't build it otherwise
+        debug = self.log.isEnabledFor(logging.DEBUG)
+
+        if self.debug and debug:
             for sect in layout:
-                self.log.debug( 'DEBUG: SECT-%d: diffscore=%.2f' % (sect.id, sect.diffscore) )
+                self.log.debug( 'DEBUG: SECT-%d: diffscore=%.2f', sect.id, sect.diffscore )
                 for b in sect.blocks:
-                    self.log.debug( '   %s' % enc(b.orig_text) )
+                    self.log.debug( '   %s', enc(b.orig_text) )
 
         xpaths = {}
         parts = []
@@ -237,20 +508,16 @@ class AutoFinder(object):
           field = None
           if sectno == pat1.title_sectno:
             field = 'title'
-            for b in sect.blocks:
-              title = enc(b.orig_text)
-              field = 'title'
-              parts.append(('TITLE',title) )
-
+            label = 'TITLE'
           elif diffscore_threshold <= sect.diffscore:
+            field = 'text'
             if pat1.title_sectno < sectno and main_threshold <= sect.mainscore:
-              field = 'text'
-              for b in sect.blocks:
-                parts.append(('MAIN-%d'%sect.id, enc(b.orig_text)) )
+              label = 'MAIN-%d'%sect.id
             else:
-              field = 'text'
-              for b in sect.blocks:
-                parts.append(('SUB-%d'%sect.id, enc(b.orig_text)) )
+              label = 'SUB-%d'%sect.id
+          if field and debug:
+            for b in sect.blocks:
+              parts.append((label, enc(b.orig_text)) )
 
           if field:
               xpath = toXPath(sect.path)
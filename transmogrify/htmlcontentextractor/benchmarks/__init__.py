@@ -0,0 +1,5 @@
+# benchmarks for the extraction hot paths. Run each module as a script, eg
+#   python -m transmogrify.htmlcontentextractor.benchmarks.nonoverlap
+# suite.py times every phase on a generated site and writes json to compare with
+#   python -m transmogrify.htmlcontentextractor.benchmarks.suite -o before.json
+#   python -m transmogrify.htmlcontentextractor.benchmarks.suite -b before.json
@@ -0,0 +1,35 @@
+"""
+Time the numpy cluster_seq_keys against cluster_seq for paths and blocks of
+increasing length. Usage: cluster_seq.py [lengths...]
+"""
+
+import sys
+import time
+import random
+from transmogrify.htmlcontentextractor.webstemmer import layoutils
+
+
+def timeit(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def main(args):
+    if layoutils.numpy is None:
+        print 'numpy is not installed'
+        return
+    lengths = [int(n) for n in args] or [20, 50, 100, 200, 400]
+    rnd = random.Random(0)
+    for n in lengths:
+        s1 = ['p%d' % rnd.randint(0, n) for i in range(n)]
+        s2 = ['p%d' % rnd.randint(0, n) for i in range(n)]
+        python_time, expected = timeit(lambda: layoutils.cluster_seq(s1, s2, lambda x, y: x == y))
+        numpy_time, result = timeit(lambda: layoutils.cluster_seq_keys(s1, s2, s2))
+        assert expected == result
+        print '%4d x %-4d cluster_seq: %8.4fs cluster_seq_keys: %8.4fs' % (n, n, python_time, numpy_time)
+    return
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,54 @@
+"""
+Time LayoutAnalyzer.analyze with and without pruning on a site with many
+page templates. Usage: clustering.py [templates] [pages per template]
+
+Both include fixating the clusters, which pruning doesn't change.
+"""
+
+import sys
+import time
+import random
+from transmogrify.htmlcontentextractor.webstemmer import analyze as webstemmer_analyze
+from transmogrify.htmlcontentextractor.webstemmer.analyze import LayoutAnalyzer
+from transmogrify.htmlcontentextractor.webstemmer.htmldom import parse
+from transmogrify.htmlcontentextractor.benchmarks.sites import page
+
+
+def analyze(pages, prune):
+    analyzer = LayoutAnalyzer(prune=prune)
+    for name, html in pages:
+        analyzer.add_tree(name, parse(html, charset='utf-8'))
+    # count the LCS comparisons, fixate makes one per cluster
+    calls = [0]
+    find_clusters = webstemmer_analyze.find_clusters
+    def counted(para_blocks):
+        calls[0] += 1
+        return find_clusters(para_blocks)
+    webstemmer_analyze.find_clusters = counted
+    try:
+        start = time.time()
+        clusters = analyzer.analyze(verbose=False)
+        taken = time.time() - start
+    finally:
+        webstemmer_analyze.find_clusters = find_clusters
+    return taken, calls[0], sorted(sorted(p.name for p in c.pages) for c in clusters)
+
+
+def main(args):
+    templates = int(args and args[0] or 20)
+    per_template = int(len(args) > 1 and args[1] or 10)
+    rnd = random.Random(0)
+    pages = [('site/%d-%d' % (t, i), page(rnd, t))
+             for i in range(per_template) for t in range(templates)]
+    print '%d pages from %d templates' % (len(pages), templates)
+
+    pruned_time, pruned_calls, pruned = analyze(pages, True)
+    print 'pruned:   %8.3fs %6d comparisons %d clusters' % (pruned_time, pruned_calls, len(pruned))
+    full_time, full_calls, full = analyze(pages, False)
+    print 'unpruned: %8.3fs %6d comparisons %d clusters' % (full_time, full_calls, len(full))
+    assert pruned == full
+    return
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,57 @@
+"""
+Measure the memory used per page by a parsed htmldom tree and by the text
+blocks LayoutAnalyzer keeps for clustering. Usage: memory.py [pages]
+"""
+
+import sys
+import random
+from transmogrify.htmlcontentextractor.webstemmer.analyze import LayoutAnalyzer
+from transmogrify.htmlcontentextractor.webstemmer.htmldom import parse
+from transmogrify.htmlcontentextractor.benchmarks.sites import page
+
+
+def deepsize(obj, seen):
+    """Bytes used by obj and everything it refers to that isn't in seen"""
+    size = 0
+    todo = [obj]
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            todo.extend(obj.keys())
+            todo.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            todo.extend(obj)
+        if hasattr(obj, '__dict__'):
+            todo.append(obj.__dict__)
+        for name in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, name):
+                todo.append(getattr(obj, name))
+    return size
+
+
+def main(args):
+    pages = int(args and args[0] or 50)
+    rnd = random.Random(0)
+    htmls = [page(rnd, i % 10) for i in range(pages)]
+    # shared strings like tag names and paths aren't counted against a page
+    seen = set()
+    trees = [parse(html, charset='utf-8') for html in htmls]
+    tree_size = sum(deepsize(tree, seen) for tree in trees)
+    print 'htmldom tree:     %8d bytes per page' % (tree_size // pages)
+
+    for keep_text in (True, False):
+        analyzer = LayoutAnalyzer(keep_text=keep_text)
+        for i, tree in enumerate(trees):
+            analyzer.add_tree('site/%d' % i, tree)
+        seen = set()
+        blocks_size = sum(deepsize(p.blocks, seen) for p in analyzer.pages.values())
+        print 'blocks keep_text=%-5s %8d bytes per page' % (keep_text, blocks_size // pages)
+    return
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
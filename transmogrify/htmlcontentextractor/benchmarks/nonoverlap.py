@@ -0,0 +1,54 @@
+"""
+Time nonoverlap against simple_nonoverlap for a rule like //p or //td that
+matches many nodes. Usage: nonoverlap.py [nodes] [repeat]
+"""
+
+import sys
+import time
+import lxml.html
+from transmogrify.htmlcontentextractor.templatefinder import \
+    nonoverlap, simple_nonoverlap, DocumentOrder
+
+
+def page(nodes):
+    rows = ''.join('<tr><td>%d</td><td><p>%d</p></td></tr>' % (i, i)
+                   for i in range(nodes // 3))
+    return '<html><body><table>%s</table></body></html>' % rows
+
+
+def timeit(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+    return best, result
+
+
+def main(args):
+    nodes = int(args and args[0] or 10000)
+    repeat = int(len(args) > 1 and args[1] or 3)
+    tree = lxml.html.fromstring(page(nodes))
+    # //td and //p overlap: every p is inside a td
+    matched = [('html', n) for n in tree.xpath('//td|//p')]
+    print 'matched %d nodes' % len(matched)
+
+    def fast():
+        return nonoverlap([], matched, DocumentOrder(tree))
+    fast_time, fast_result = timeit(fast, repeat)
+    print 'nonoverlap:        %8.3fs' % fast_time
+
+    # the pairwise version is quadratic so only time it on a slice
+    sample = matched[:min(len(matched), 1000)]
+    def simple():
+        return simple_nonoverlap([], sample)
+    simple_time, simple_result = timeit(simple, 1)
+    print 'simple_nonoverlap: %8.3fs (%d nodes)' % (simple_time, len(sample))
+    assert simple_result == nonoverlap([], sample, DocumentOrder(tree))
+    return
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,36 @@
+"""
+Synthetic sites for the benchmarks. Every page is made from one of a number
+of templates, each with its own layout of navigation, sections and footer,
+and the same seed always gives the same site.
+"""
+
+import random
+
+
+WORDS = ('alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu nu xi '
+         'omicron pi rho sigma tau upsilon phi chi psi omega').split()
+
+def text(rnd, words):
+    return ' '.join(rnd.choice(WORDS) for i in range(words))
+
+
+def page(rnd, template):
+    # each template has its own layout of navigation, sidebars and content
+    sections = []
+    for i in range(3 + template % 4):
+        sections.append('<div class="t%d-s%d"><h3>Section %d of template %d</h3><p>%s</p></div>'
+                        % (template, i, i, template, text(rnd, rnd.randint(10, 40))))
+    return ('<html><head><title>%s</title></head><body>'
+            '<div id="header-%d"><h1>Site %d</h1><ul><li>Home</li><li>News</li></ul></div>'
+            '<div id="main-%d"><h2>%s</h2>%s</div>'
+            '<div id="footer"><p>Copyright, all rights reserved.</p></div>'
+            '</body></html>') % (text(rnd, 4), template, template, template,
+                                 text(rnd, 6), ''.join(sections))
+
+
+def site(pages, templates, seed=0):
+    """Yield (path, html) for each page of a site"""
+    rnd = random.Random(seed)
+    for i in xrange(pages):
+        template = i % templates
+        yield ('page-%d-%d.html' % (template, i), page(rnd, template))
@@ -0,0 +1,214 @@
+"""
+Time each phase of analysing and extracting a synthetic site and write the
+results as JSON so runs on different commits can be compared.
+
+Usage: suite.py [-p pages,...] [-t templates] [-s seed] [-l learn] [-r repeat]
+                [-o output.json] [-b baseline.json] [phase ...]
+
+Phases are run in this order, all of them by default:
+
+  tokenize        HTMLParser3 with a handler that does nothing
+  parse           htmldom.parse without styles
+  chunk           get_textblocks on htmldom trees
+  cluster         LayoutAnalyzer.add_tree and analyze on the first `learn` pages
+  identify        LayoutPatternSet.identify_layout on lxml trees
+  templatefinder  TemplateFinder with a rule group per template
+
+Pages are generated as they are needed so sites of 100k pages don't have to
+fit in memory, and only the phase itself is timed. Clustering compares a page
+with every page of the cluster it joins, so it only uses the first `learn`
+pages (200 by default) as the auto blueprint's sample option does.
+"""
+
+import os
+import sys
+import time
+import json
+import getopt
+import logging
+import platform
+import subprocess
+import lxml.html
+from transmogrify.htmlcontentextractor.webstemmer.htmlparser3 import HTMLParser3, HTMLHandler
+from transmogrify.htmlcontentextractor.webstemmer.htmldom import parse
+from transmogrify.htmlcontentextractor.webstemmer.layoutils import get_textblocks
+from transmogrify.htmlcontentextractor.webstemmer.analyze import LayoutAnalyzer, NullProgress
+from transmogrify.htmlcontentextractor.webstemmer.extract import LayoutPatternSet, LayoutPattern
+from transmogrify.htmlcontentextractor.benchmarks.sites import site
+
+
+PHASES = ['tokenize', 'parse', 'chunk', 'cluster', 'identify', 'templatefinder']
+
+
+class NullHandler(HTMLHandler):
+
+    def start_unknown(self, tag, attrs):
+        return
+
+    def end_unknown(self, tag):
+        return
+
+    def do_unknown(self, tag, attrs):
+        return
+
+    def handle_data(self, data):
+        return
+
+
+class Timer(object):
+    """Adds up the time spent in the calls it makes"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.pages = 0
+        self.bytes = 0
+
+    def __call__(self, html, func, *args):
+        start = time.time()
+        result = func(*args)
+        self.seconds += time.time() - start
+        self.pages += 1
+        self.bytes += len(html)
+        return result
+
+
+def tokenize(html):
+    parser = HTMLParser3(NullHandler(), charset='utf-8')
+    parser.feed_byte(html)
+    parser.close()
+
+
+def learn(pages, timer=None):
+    """Return the LayoutPatternSet learnt from pages"""
+    # sampled diffscores, as the auto blueprint uses by default
+    analyzer = LayoutAnalyzer(keep_text=False, diff_error=0.05, progress=NullProgress())
+    for (name, html) in pages:
+        tree = parse(html, charset='utf-8', styles=False)
+        if timer is None:
+            analyzer.add_tree(name, tree)
+        else:
+            timer(html, analyzer.add_tree, name, tree)
+    start = time.time()
+    clusters = analyzer.analyze(verbose=False)
+    if timer is not None:
+        timer.seconds += time.time() - start
+    patternset = LayoutPatternSet()
+    patternset.pats = [LayoutPattern(c.name, c.score, c.title_sectno, -1, c.pattern)
+                       for c in clusters if c.pattern]
+    return patternset
+
+
+def templatefinder(pages, templates, timer):
+    from transmogrify.htmlcontentextractor.templatefinder import TemplateFinder
+    rules = '\n'.join('%d-title = //div[@id="main-%d"]/h2/text()\n'
+                      '%d-text = //div[@id="main-%d"]' % (t, t, t, t)
+                      for t in range(templates))
+    options = {'blueprint': 'transmogrify.htmlcontentextractor', 'rules': rules}
+    logging.getLogger('benchmark').setLevel(logging.WARNING)
+    # the time spent making the pages isn't counted
+    made = [0.0]
+    def items():
+        start = time.time()
+        for (path, html) in pages:
+            timer.bytes += len(html)
+            item = {'_site_url': 'http://site/', '_path': path, 'text': html}
+            made[0] += time.time() - start
+            yield item
+            start = time.time()
+        made[0] += time.time() - start
+    start = time.time()
+    for item in TemplateFinder(None, 'benchmark', options, items()):
+        timer.pages += 1
+    timer.seconds += time.time() - start - made[0]
+
+
+def run_phase(phase, pages, templates, seed, learnt, context):
+    timer = Timer()
+    if phase == 'tokenize':
+        for (name, html) in site(pages, templates, seed):
+            timer(html, tokenize, html)
+    elif phase == 'parse':
+        for (name, html) in site(pages, templates, seed):
+            timer(html, parse, html, None, 'utf-8', None, False)
+    elif phase == 'chunk':
+        for (name, html) in site(pages, templates, seed):
+            timer(html, get_textblocks, parse(html, charset='utf-8', styles=False))
+    elif phase == 'cluster':
+        context['patternset'] = learn(site(min(pages, learnt), templates, seed), timer)
+    elif phase == 'identify':
+        if 'patternset' not in context:
+            context['patternset'] = learn(site(min(pages, learnt), templates, seed))
+        patternset = context['patternset']
+        for (name, html) in site(pages, templates, seed):
+            timer(html, patternset.identify_layout, lxml.html.document_fromstring(html), 0.8)
+    elif phase == 'templatefinder':
+        templatefinder(site(pages, templates, seed), templates, timer)
+    return dict(seconds=timer.seconds, pages=timer.pages, bytes=timer.bytes,
+                pages_per_second=timer.pages / max(timer.seconds, 1e-9),
+                mb_per_second=timer.bytes / 1e6 / max(timer.seconds, 1e-9))
+
+
+def revision():
+    """The git revision of the code being timed, if there is one"""
+    try:
+        out = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+    except OSError:
+        return None
+    return out.strip() or None
+
+
+def main(args):
+    try:
+        (opts, phases) = getopt.getopt(args, 'p:t:s:l:r:o:b:')
+    except getopt.GetoptError:
+        print __doc__
+        return 2
+    sizes = [100, 1000]
+    (templates, seed, learnt, repeat, output, baseline) = (10, 0, 200, 1, None, None)
+    for (k, v) in opts:
+        if k == '-p': sizes = [int(n) for n in v.split(',')]
+        elif k == '-t': templates = int(v)
+        elif k == '-s': seed = int(v)
+        elif k == '-l': learnt = int(v)
+        elif k == '-r': repeat = int(v)
+        elif k == '-o': output = v
+        elif k == '-b': baseline = v
+    for phase in phases:
+        if phase not in PHASES:
+            print 'unknown phase %r, choose from %s' % (phase, ' '.join(PHASES))
+            return 2
+    phases = [phase for phase in PHASES if phase in (phases or PHASES)]
+
+    results = dict(revision=revision(), python=sys.version.split()[0],
+                   platform=platform.platform(), time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   templates=templates, seed=seed, learn=learnt, repeat=repeat, runs=[])
+    if baseline:
+        baseline = dict((run['pages'], run['phases']) for run in json.load(open(baseline))['runs'])
+    for pages in sizes:
+        run = dict(pages=pages, phases={})
+        context = {}
+        for phase in phases:
+            # the fastest of repeat runs
+            timing = min((run_phase(phase, pages, templates, seed, learnt, context)
+                          for i in range(repeat)), key=lambda t: t['seconds'])
+            run['phases'][phase] = timing
+            line = '%7d pages %-15s %9.3fs %9.1f pages/s %7.2f MB/s' % \
+                   (pages, phase, timing['seconds'], timing['pages_per_second'],
+                    timing['mb_per_second'])
+            if baseline and phase in baseline.get(pages, {}):
+                line += ' %5.2fx baseline' % (baseline[pages][phase]['seconds'] /
+                                              max(timing['seconds'], 1e-9))
+            print line
+            sys.stdout.flush()
+        results['runs'].append(run)
+    if output:
+        fp = open(output, 'w')
+        json.dump(results, fp, indent=1, sort_keys=True)
+        fp.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,82 @@
+"""
+Measure SGMLParser3 throughput in MB/s with and without the regexp fast path
+on a corpus of html pages. Usage: tokenizer.py [files or directories...]
+
+With no arguments the pages in webstemmer/docs are used.
+"""
+
+import os
+import sys
+import time
+from transmogrify.htmlcontentextractor.webstemmer.sgmlparser3 import SGMLParser3
+
+
+class Recorder(SGMLParser3):
+    """Keep every handler call so both modes can be compared"""
+
+    def __init__(self, fast):
+        SGMLParser3.__init__(self, fast=fast)
+        self.calls = []
+
+    def handle_start_tag(self, name, attrs):
+        self.calls.append(('start', name, attrs))
+        if name in ('script', 'style'):
+            self.start_cdata(name)
+
+    def handle_end_tag(self, name, attrs):
+        self.calls.append(('end', name, attrs))
+
+    def handle_decl(self, name):
+        self.calls.append(('decl', name))
+
+    def handle_directive(self, name, attrs):
+        self.calls.append(('directive', name, attrs))
+
+    def handle_characters(self, data):
+        self.calls.append(('characters', data))
+
+
+def corpus(args):
+    if not args:
+        args = [os.path.join(os.path.dirname(__file__), '..', 'webstemmer', 'docs')]
+    for arg in args:
+        if os.path.isdir(arg):
+            for (dirpath, dirnames, filenames) in os.walk(arg):
+                for name in sorted(filenames):
+                    if name.endswith('.html') or name.endswith('.htm'):
+                        yield os.path.join(dirpath, name)
+        else:
+            yield arg
+
+
+def tokenize(pages, fast):
+    # fed a line at a time as HTMLParser3.feed_file does
+    calls = []
+    start = time.time()
+    for lines in pages:
+        parser = Recorder(fast)
+        for line in lines:
+            parser.feed(line)
+        parser.close()
+        calls.append(parser.calls)
+    return time.time() - start, calls
+
+
+def main(args):
+    pages = []
+    size = 0
+    for path in corpus(args):
+        data = open(path, 'rb').read()
+        size += len(data)
+        pages.append([line.decode('utf-8', 'replace') for line in data.splitlines(True)])
+    print '%d pages, %.2f MB' % (len(pages), size / 1e6)
+    slow_time, expected = tokenize(pages, False)
+    print 'state machine: %8.3fs %6.2f MB/s' % (slow_time, size / 1e6 / slow_time)
+    fast_time, calls = tokenize(pages, True)
+    print 'fast path:     %8.3fs %6.2f MB/s' % (fast_time, size / 1e6 / fast_time)
+    assert calls == expected
+    return
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
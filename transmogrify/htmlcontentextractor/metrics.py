@@ -0,0 +1,79 @@
+"""
+Timings and counters kept by the blueprints while a pipeline runs.
+
+Each section keeps its metrics in a dict of plain numbers so they can be
+added up across pages and worker processes and dumped as they are. Timings
+are {'count': n, 'seconds': s}. 'rules' and 'groups' hold a dict of counters
+per rule or group. With the `metrics` option the dict is written to a file
+once the section has passed on its last item, as json or, with
+`metrics_format = prometheus`, in Prometheus' text format.
+"""
+
+import os
+import json
+import time
+
+
+# labelled families in the prometheus output, by their key in the metrics
+LABELS = {'rules': 'rule', 'groups': 'group'}
+
+
+def timed(metrics, key, start):
+    """Add the time since start to the timing metrics[key]"""
+    timing = metrics.setdefault(key, {'count': 0, 'seconds': 0.0})
+    timing['count'] += 1
+    timing['seconds'] += time.time() - start
+
+
+def count(metrics, key, n=1):
+    metrics[key] = metrics.get(key, 0) + n
+
+
+def merge(total, metrics):
+    """Add metrics into total"""
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            merge(total.setdefault(key, {}), value)
+        else:
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def prometheus(metrics, section, prefix='transmogrify_htmlcontentextractor'):
+    """Return metrics in Prometheus' text format, labelled with the section name"""
+    # every sample of a metric has to be together, after its TYPE line
+    samples = {}
+    def escape(value):
+        return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    def sample(name, labels, value):
+        labels = ','.join('%s="%s"' % (k, escape(v)) for k, v in [('section', section)] + labels)
+        samples.setdefault('%s_%s' % (prefix, name), []).append('{%s} %r' % (labels, value))
+    def walk(name, labels, value):
+        if isinstance(value, dict):
+            for key in sorted(value):
+                walk('%s_%s' % (name, key), labels, value[key])
+        else:
+            sample(name, labels, value)
+    for key in sorted(metrics):
+        value = metrics[key]
+        if key in LABELS:
+            for label in sorted(value):
+                walk(key, [(LABELS[key], label)], value[label])
+        else:
+            walk(key, [], value)
+    lines = []
+    for name in sorted(samples):
+        lines.append('# TYPE %s untyped' % name)
+        lines.extend(name + line for line in samples[name])
+    return '\n'.join(lines) + '\n'
+
+
+def write(metrics, path, section, format='json'):
+    """Write metrics to path, replacing it once it's complete"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fp:
+        if format == 'prometheus':
+            fp.write(prometheus(metrics, section).encode('utf-8'))
+        else:
+            json.dump(metrics, fp, indent=1, sort_keys=True)
+    os.rename(tmp, path)
@@ -16,8 +16,13 @@ except ImportError:
     # python 2.6 or earlier, use backport
     from ordereddict import OrderedDict
 import logging
+import multiprocessing
 import urlparse
 import sys
+import weakref
+import time
+from collections import deque
+from transmogrify.htmlcontentextractor import metrics as metricutils
 
 """
 transmogrify.htmlcontentextractor
@@ -54,7 +59,8 @@ Options:
   Newline separated list of rules either
   'field = XPATH, or 'field = optional XPATH'. Each XPATH must match unless the 'optional' keyword is
   used. Each XPATH removes it's selected nodes from the html and no two XPATHs can select
-  the same html node.
+  the same html node. A rule for the field 'path', e.g. '2-path = news/index.html',
+  limits its group to the item with that _path.
 
 :tal:
   Newline separated list of tal expressions of the form 'field = TAL_EXPRESSION'. These act after the
@@ -68,7 +74,8 @@ Options:
 
 :repeat:
   Extract metadata about content linked to it a list on a page. Repeat is an XPATH
-  where each other XPATH is relative to. To use repeat you need to also specify a 'url'.
+  where each other XPATH is relative to. To use repeat you need to also specify a 'url',
+  without one it is ignored and the rules are run against the whole page.
 
 :url:
   a XPATH which selects a href which links to the item. Any fields matched will
@@ -81,10 +88,41 @@ Options:
   matched another templatefinder blueprint before this one. Determining if a previous template has already matched is
   done by checking the existances of the '_template' field which is set on a successful match with the remaining html.
 
+:stream:
+  default 'No'. If 'True', items are passed on as soon as they are processed rather than reading in every item
+  first when using `repeat`. Metadata for linked items is kept until the linked item comes through the pipeline,
+  so it's only applied to items after the page that links to them. TAL rules are run once the linked item
+  arrives so they see its fields, as they would without `stream`.
+
+:max_pending:
+  default 10000. When using `stream`, the maximum number of linked items to keep metadata for. The oldest
+  is dropped once the limit is reached.
+
+:max_seen:
+  default 100000. When using `stream`, the number of urls of items already passed on that are remembered so
+  links to them are ignored, about 100 bytes each. The oldest is forgotten once the limit is reached and
+  links to it then take up a place in `max_pending` until dropped.
+
+:workers:
+  default 0. The number of processes to extract pages in. Each item's html is sent to a worker and the
+  results are merged back in the order items arrived. Not used with `url`.
+
+:worker_max_tasks:
+  default 1000. The number of pages a worker extracts before it's replaced with a new process, to keep
+  memory from growing. 0 means never.
+
 :generate_missing:
   default 'No'. When using `_apply_to_paths` and the item refered to by the link doesn't yet exist, create it. Generally
   this should not be the case as the whole site will be crawled.
 
+:metrics:
+  file to write the section's timings and counters to once it has passed on its last item. They are
+  also kept in the section's `metrics` dict: parse and serialize times, evaluations, hits and time
+  of each rule by 'group-field', and the pages each group was tried, matched and skipped for.
+
+:metrics_format:
+  default 'json'. 'prometheus' writes the metrics in Prometheus' text format instead.
+
 
 """
 
@@ -95,6 +133,21 @@ attr = re.compile(r':(?P<attr>[^/:]*)=(?P<val>[^/:]*)')
 class TALException(Exception):
     pass
 
+def compileRule(format, xp):
+    """Return (format, XPath) with the XPath compiled once up front.
+
+    A trailing '/text()' is stripped so normal node operations still work
+    and the format is switched to the matching text variant instead.
+    """
+    xp = xp.strip()
+    if xp.lower().endswith('/text()'):
+        xp = xp[:-7]
+        if format.lower().endswith('html'):
+            format = format.lower()[:-4] + 'text'
+        elif format.lower().startswith('optional'):
+            format = 'optionaltext'
+    return format, etree.XPath(xp, namespaces=ns)
+
 def toXPath(pat):
     #td:valign=top/p:class=msonormal/span
     pat = attr.sub(r'[re:test(@\g<attr>,"^\g<val>$","i")]', pat)
@@ -105,6 +158,20 @@ default_charset = 'utf-8'
 
 NOTSET = object()
 
+
+class LazyHTML(object):
+    """Serialises a node only when a log message using it is formatted"""
+
+    def __init__(self, node, method='html'):
+        self.node = node
+        self.method = method
+
+    def __unicode__(self):
+        return etree.tostring(self.node, method=self.method, encoding=unicode)
+
+    def __str__(self):
+        return unicode(self).encode(default_charset)
+
 class TemplateFinder(object):
     classProvides(ISectionBlueprint)
     implements(ISection)
@@ -121,13 +188,33 @@ class TemplateFinder(object):
             return default
         self.repeat = best(['repeat', 'match', '_match'], '/')
         self.url = best(['url', 'apply_to_paths', '_apply_to_paths'], '')
+        self.repeat_xpath = self.repeat and etree.XPath(self.repeat, namespaces=ns) or None
+        self.url_xpath = self.url and etree.XPath(self.url, namespaces=ns) or None
+        if self.repeat not in ('', '/') and not self.url:
+            self.logger.warning("repeat %r is ignored without a url", self.repeat)
 
         self.act_as_filter = best(['act_as_filter', '_act_as_filter'], "No")
         self.act_as_filter = self.act_as_filter.lower() in ('yes', 'true')
         self.generate_missing = options.get('_generate_missing',
                                             options.get('_generate_missing', "No")).lower() in ('yes', 'true')
 
+        self.stream = best(['stream', '_stream'], "No").lower() in ('yes', 'true')
+        self.max_pending = int(best(['max_pending', '_max_pending'], '10000'))
+        self.max_seen = int(best(['max_seen', '_max_seen'], '100000'))
+        self.workers = int(best(['workers', '_workers'], '0'))
+        self.worker_max_tasks = int(best(['worker_max_tasks', '_worker_max_tasks'], '1000')) or None
+        self.metrics_file = best(['metrics', '_metrics'], '')
+        self.metrics_format = best(['metrics_format', '_metrics_format'], 'json').lower()
+        self.metrics = {}
+
         self.text_key = options.get('html-key', 'text').strip()
+        # set by the next section if it's also a TemplateFinder. Trees that
+        # weren't changed are then left on the item in '_tree' for it to use
+        # rather than parsing the html again
+        self.keep_tree = False
+        upstream = UPSTREAM.get(previous)
+        if upstream is not None:
+            upstream.keep_tree = True
         self.template_key = options.get('remainder-key', '_template').strip()
 
         rules = options.get('rules','')
@@ -140,7 +227,9 @@ class TemplateFinder(object):
             def specialkey(key):
                 if key in ['blueprint', 'debug', '_order', '_match',
                     '_apply_to_paths', '_apply_to_paths_prefix', '_act_as_filter',
-                    '_generate_missing', 'html-key', 'remainder-key']:
+                    '_generate_missing', 'html-key', 'remainder-key',
+                    '_stream', '_max_pending', '_max_seen', '_workers', '_worker_max_tasks',
+                    '_metrics', '_metrics_format']:
                     return True
                 if key in order:
                     return True
@@ -156,6 +245,10 @@ class TemplateFinder(object):
                 group = int(group)
             except:
                 group, field = '1', key
+            if field == 'path':
+                # the _path of the items the group applies to, not an XPath
+                self.groups.setdefault(group, OrderedDict())[field] = value.strip()
+                continue
             xps = []
             res = re.findall("(?m)^(text|html|optional|delete|tal|optionaltext|optionalhtml)\s(.*)$", value)
             if not res:
@@ -165,8 +258,10 @@ class TemplateFinder(object):
             for line in value.strip().split('\n'):
                 xp = line.strip()
                 if format.lower() == 'tal':
-                    xp = Expression(xp, transmogrifier, name, options, datetime=datetime, DateTime=DateTime)
-                xps.append((format, xp))
+                    xps.append((format, Expression(xp, transmogrifier, name, options,
+                                                   datetime=datetime, DateTime=DateTime)))
+                else:
+                    xps.append(compileRule(format, xp))
             group = self.groups.setdefault(group, OrderedDict())
             group[field] = xps
 
@@ -178,101 +273,361 @@ class TemplateFinder(object):
             for key,rule in tal:
                 self.tal.append(( key, Expression(rule, transmogrifier, name, options, datetime=datetime)))
 
+        # what a page must contain for each group to have a chance of matching
+        self.signatures = {}
+        for groupname, group in self.groups.items():
+            tags, ids, classes = set(), set(), set()
+            for field, xps in group.items():
+                if field == 'path':
+                    continue
+                for format, xp in xps:
+                    if format.lower() == 'tal' or format.lower().startswith('optional'):
+                        continue
+                    signature = ruleSignature(xp.path)
+                    if signature is not None:
+                        tags.update(signature[0])
+                        ids.update(signature[1])
+                        classes.update(signature[2])
+            if tags or ids or classes:
+                self.signatures[groupname] = (tags, ids, classes)
 
 
     def __iter__(self):
+        items = self.extractItems()
+        UPSTREAM[items] = self
+        return items
+
+    def extractItems(self):
         site_items = []
         site_items_lookup = {}
-        if self.repeat:
+        # streaming: url -> (fields, groupname) for items that haven't arrived
+        # yet, and the urls of the latest items passed on
+        pending = OrderedDict()
+        seen = OrderedDict()
+        evicted = 0
+        if self.url and self.stream:
+            site_items = self.previous
+        elif self.url:
             # In this case we need all items to be processed first so
             # we can match any urls we find to the existing item and merge
             for item in self.previous:
                 site_items.append(item)
                 if '_path' in item:
-                    site_items_lookup[item['_site_url']+item['_path']] = item
+                    site_items_lookup[item.get('_site_url', '')+item['_path']] = item
         else:
             site_items = self.previous
 
-        notextracted = []
+        self.metrics = {}
+        notextracted = [0]
         total = 0
         skipped = 0
         alreadymatched = 0
         stats = {}
-        for item in site_items:
-            #import pdb; pdb.set_trace()
-            total += 1
-            content = self.getHtml(item)
-            path = item.get('_path', '')
-            if content is None:
-                #log.warning('(%s) content is None'%item['_path'])
-                skipped += 1
-                if path:
-                    self.logger.debug("SKIP: %s (no html)" % (path))
+        # number of groups tried per item -> number of items
+        groups_tried = {}
+        # group -> number of pages it was skipped for by its signature
+        groups_skipped = {}
+        # items in pipeline order with the result of extractPage if any
+        waiting = deque()
+        def finished(limit):
+            while len(waiting) > limit:
+                item, page = waiting.popleft()
+                if page is not None and not self.finishPage(item, page, stats, groups_tried, groups_skipped):
+                    notextracted[0] += 1
+                if not self.keep_tree:
+                    item.pop('_tree', None)
                 yield item
+
+        pool = None
+        inflight = 0
+        if self.workers and not self.url:
+            # workers are forked so they start with this section and its
+            # compiled rules
+            WORKER_SECTIONS[self.name] = self
+            pool = multiprocessing.Pool(self.workers, maxtasksperchild=self.worker_max_tasks)
+            inflight = self.workers * 2
+        try:
+            for item in site_items:
+                total += 1
+                if self.stream and '_path' in item:
+                    url = item.get('_site_url', '') + item['_path']
+                    seen[url] = None
+                    if len(seen) > self.max_seen:
+                        seen.popitem(last=False)
+                    if url in pending:
+                        self.applyPending(item, *pending.pop(url))
+                content = self.getHtml(item)
+                path = item.get('_path', '')
+                if content is None:
+                    skipped += 1
+                    if path:
+                        self.logger.debug("SKIP: %s (no html)", path)
+                    waiting.append((item, None))
+                elif not self.act_as_filter and self.template_key in item:
+                    # don't apply the template if another has already been applied
+                    alreadymatched += 1
+                    self.logger.debug("SKIP: %s (already extracted)", item['_path'])
+                    waiting.append((item, None))
+                elif not self.url:
+                    if pool is None:
+                        parsed = self.parse(item, content)
+                        page = self.extractPage(path, content, parsed, self.metrics)
+                        if page[0] is None and self.keep_tree:
+                            # nothing was removed so the next section can use it
+                            item['_tree'] = (content,) + parsed
+                    else:
+                        item.pop('_tree', None)
+                        page = pool.apply_async(extractInWorker, (self.name, path, content))
+                    waiting.append((item, page))
+                else:
+                    if not self.extractLinked(item, content, stats, groups_tried, groups_skipped,
+                                              site_items_lookup, pending, seen):
+                        notextracted[0] += 1
+                    while len(pending) > self.max_pending:
+                        pending.popitem(last=False)
+                        evicted += 1
+                    waiting.append((item, None))
+                for done in finished(inflight):
+                    yield done
+            for done in finished(0):
+                yield done
+        finally:
+            if pool is not None:
+                pool.terminate()
+                del WORKER_SECTIONS[self.name]
+
+        if pending or evicted:
+            self.logger.info("SKIP: metadata for %d urls never crawled, %d dropped as max_pending=%d",
+                             len(pending), evicted, self.max_pending)
+        self.logger.info("extracted %d/%d/%d/%d %s groups tried=%s skipped=%s",
+                         total - notextracted[0] - alreadymatched - skipped,
+                         total - alreadymatched - skipped,
+                         total - skipped,
+                         total, stats, groups_tried, groups_skipped)
+        self.metrics['items'] = dict(total=total, skipped=skipped, already_extracted=alreadymatched,
+                                     extracted=total - notextracted[0] - alreadymatched - skipped)
+        if self.metrics_file:
+            metricutils.write(self.metrics, self.metrics_file, self.name, self.metrics_format)
+
+    def parse(self, item, content):
+        """Return (tree, order, page) for content. The tree left on item by
+        the section before is used if it was parsed from the same content.
+        """
+        cached = item.pop('_tree', None)
+        if cached is not None and cached[0] is content:
+            metricutils.count(self.metrics, 'trees_reused')
+            return cached[1:]
+        start = time.time()
+        tree = lxml.html.fromstring(content)
+        parsed = tree, DocumentOrder(tree), PageSignature(tree)
+        metricutils.timed(self.metrics, 'parse', start)
+        return parsed
+
+    def extractPage(self, path, content, parsed=None, metrics=None):
+        """Run the rules against the html of a page.
+
+        Returns (result, tried, skipped, trace, metrics) where result is a
+        (groupname, fields, optional, extracted, remainder) tuple for the
+        group that matched, or None, skipped lists the groups ruled out
+        by their signature and metrics are the page's timings and counters,
+        added to the metrics passed in if any. Only needs the path and html
+        so it can be run in a worker process. parsed is the result of parse
+        if there is one.
+        """
+        if metrics is None:
+            metrics = {}
+        if parsed is None:
+            start = time.time()
+            tree = lxml.html.fromstring(content)
+            parsed = tree, DocumentOrder(tree), PageSignature(tree)
+            metricutils.timed(metrics, 'parse', start)
+        tree, order, page = parsed
+        groups = metrics.setdefault('groups', {})
+        item = {'_path': path}
+        tried = 0
+        skipped = []
+        # failure messages for each group, only logged if no group matched
+        trace = []
+        # try each group in turn to see if they work. Matching is
+        # read-only so the tree is only changed by the winning group
+        # and the page never needs to be parsed again.
+        for groupname in sorted(self.groups.keys()):
+            group = self.groups[groupname]
+            if group.get('path', path) != path:
                 continue
-            if not self.act_as_filter and self.template_key in item:
-                # don't apply the template if another has already been applied
-                alreadymatched += 1
-                self.logger.debug("SKIP: %s (already extracted)" % (item['_path']))
-                yield item
+            if self.excluded(groupname, page, path, trace):
+                skipped.append(groupname)
+                metricutils.count(groups.setdefault(groupname, {}), 'skipped')
                 continue
-            base = item['_site_url']+item['_path']
-            tree = lxml.html.fromstring(content)
-            if self.repeat:
-                repeated = tree.xpath(self.repeat, namespaces=ns)
+            tried += 1
+            metricutils.count(groups.setdefault(groupname, {}), 'tried')
+            matched = self.match(group, tree, item, order, trace, metrics, groupname)
+            if matched is not None:
+                metricutils.count(groups[groupname], 'matched')
+                unique, optional = matched
+                start = time.time()
+                extracted = self.dropNodes(unique)
+                remainder = self.remainder(tree)
+                metricutils.timed(metrics, 'serialize', start)
+                return ((groupname, unique.keys(), optional, extracted, remainder),
+                        tried, skipped, trace, metrics)
+        return None, tried, skipped, trace, metrics
+
+    def finishPage(self, item, page, stats, groups_tried, groups_skipped):
+        """Update item from the result of extractPage. Returns True if
+        a group matched.
+        """
+        if not isinstance(page, tuple):
+            # from a worker, its metrics still need adding up
+            page = page.get()
+            metricutils.merge(self.metrics, page[4])
+        result, tried, skipped, trace, metrics = page
+        if result is not None:
+            groupname, fields, optional, extracted, remainder = result
+            self.update(self.groups[groupname], item, stats, fields, optional,
+                        extracted, remainder)
+        else:
+            for level, msg, args in trace:
+                self.logger.log(level, msg, *args)
+        self.logger.debug("TRIED: %s (%d groups)", item['_path'], tried)
+        groups_tried[tried] = groups_tried.get(tried, 0) + 1
+        for groupname in skipped:
+            groups_skipped[groupname] = groups_skipped.get(groupname, 0) + 1
+        return result is not None
+
+    def extractLinked(self, item, content, stats, groups_tried, groups_skipped,
+                      site_items_lookup, pending, seen):
+        """Extract metadata for the items linked from each repeat on this
+        page. Returns True if a group matched.
+        """
+        base = item.get('_site_url', '')+item['_path']
+        parsed = self.parse(item, content)
+        tree, order, page = parsed
+        repeated = self.repeat_xpath(tree)
+
+        gotit = False
+        uncrawled_targets = 0
+        tried = 0
+        # failure messages for each group, only logged if no group matched
+        trace = []
+        groups = self.metrics.setdefault('groups', {})
+        for fragment in repeated:
+            # get each target_item in the path selection and process with fragment_content
+            if self.stream:
+                target_item = self.pendingTarget(item, fragment, seen)
+                if target_item is None:
+                    uncrawled_targets += 1
+                    continue
             else:
-                repeated = [tree]
-
-            gotit = False
-            uncrawled_targets = 0
-            for fragment in repeated:
-                # get each target_item in the path selection and process with fragment_content
-                if self.repeat:
-                    target_item = None
-                    for target_url in fragment.xpath(self.url, namespaces=ns):
-                        target_url = urlparse.urljoin(base, target_url.strip("/"))
-                        if target_url in site_items_lookup:
-                            target_item = site_items_lookup[target_url]
-                            break
-                    if target_item is None:
-                        # we haven't crawled the target page so can't set the
-                        # metadata.
-                        uncrawled_targets += 1
-                        continue
-                else:
-                    target_item = item
-                path = target_item['_path']
-
-                # try each group in turn to see if they work
-                for groupname in sorted(self.groups.keys()):
-                    group = self.groups[groupname]
-                    #TODO: before we reset the tree for each group attempt
-                    # we could copy the document each time?, or else
-                    # perhaps a group should be applied to all repeats first?
-                    # the problem is that extract removes parts from the document
-                    # probably should make extract keep tree intact unless it matches.
-                    #tree = lxml.html.fromstring(content)
-
-                    if group.get('path', path) == path and \
-                            self.extract(group, fragment, target_item, stats):
-                        gotit = True
+                target_item = None
+                for target_url in self.url_xpath(fragment):
+                    target_url = urlparse.urljoin(base, target_url.strip("/"))
+                    if target_url in site_items_lookup:
+                        target_item = site_items_lookup[target_url]
                         break
-                if not gotit:
-                    #one of the repeats didn't match so we stop processing item
-                    break
-            if uncrawled_targets:
-                self.logger.info("SKIP: %s (can't apply metadata to %s not crawled urls)" % (item['_path'], uncrawled_targets))
+                if target_item is None:
+                    # we haven't crawled the target page so can't set the
+                    # metadata.
+                    uncrawled_targets += 1
+                    continue
+            path = target_item['_path']
 
+            matched = None
+            for groupname in sorted(self.groups.keys()):
+                group = self.groups[groupname]
+                if group.get('path', path) != path:
+                    continue
+                if self.excluded(groupname, page, path, trace):
+                    groups_skipped[groupname] = groups_skipped.get(groupname, 0) + 1
+                    metricutils.count(groups.setdefault(groupname, {}), 'skipped')
+                    continue
+                tried += 1
+                metricutils.count(groups.setdefault(groupname, {}), 'tried')
+                matched = self.match(group, fragment, target_item, order, trace,
+                                     self.metrics, groupname)
+                if matched is not None:
+                    metricutils.count(groups[groupname], 'matched')
+                    # when streaming the TAL rules wait for the real item
+                    self.apply(group, fragment, target_item, stats, matched,
+                               tal=not self.stream)
+                    gotit = True
+                    break
+            if matched is not None and self.stream:
+                url = target_item.pop('_site_url') + target_item.pop('_path')
+                fields = pending.get(url, ({}, None))[0]
+                fields.update(target_item)
+                pending[url] = (fields, groupname)
             if not gotit:
-                notextracted.append(item)
-            yield item
-
-        self.logger.info("extracted %d/%d/%d/%d %s" % (total - len(notextracted) - alreadymatched - skipped,
-                                                       total - alreadymatched - skipped,
-                                                       total - skipped,
-                                                       total, stats))
+                #one of the repeats didn't match so we stop processing item
+                break
+        if uncrawled_targets:
+            self.logger.info("SKIP: %s (can't apply metadata to %s not crawled urls)", item['_path'], uncrawled_targets)
+
+        if not gotit:
+            for level, msg, args in trace:
+                self.logger.log(level, msg, *args)
+            if self.keep_tree:
+                item['_tree'] = (content,) + parsed
+        self.logger.debug("TRIED: %s (%d groups)", item['_path'], tried)
+        groups_tried[tried] = groups_tried.get(tried, 0) + 1
+        return gotit
+
+    def excluded(self, groupname, page, path, trace):
+        """True if the page is missing a tag, id or class the mandatory
+        rules of the group need, so its XPaths don't need running.
+        """
+        signature = self.signatures.get(groupname)
+        if signature is None:
+            return False
+        missing = page.missing(signature)
+        if missing and self.logger.isEnabledFor(logging.INFO):
+            trace.append((logging.INFO, "FAIL: '%s' group %s needs %s", (path, groupname, missing)))
+        return bool(missing)
+
+    def pendingTarget(self, item, fragment, seen):
+        """Return a placeholder item for the page linked from fragment.
+
+        Used when streaming, the fields extracted into it are kept in the
+        pending index until the real item comes past. Returns None if the
+        linked page has already gone through the pipeline. Items without a
+        _site_url can only link to other paths.
+        """
+        site_url = item.get('_site_url', '')
+        base = site_url + item['_path']
+        for target_url in self.url_xpath(fragment):
+            target_url = urlparse.urljoin(base, target_url.strip("/"))
+            if not target_url.startswith(site_url) or target_url in seen:
+                continue
+            if not site_url and any(urlparse.urlsplit(target_url)[:2]):
+                # a scheme or host, so not a path
+                continue
+            return {'_site_url': site_url, '_path': target_url[len(site_url):]}
+        return None
 
     def extract(self, pats, tree, item, stats):
+        matched = self.match(pats, tree, item, DocumentOrder(tree))
+        if matched is None:
+            return False
+        return self.apply(pats, tree, item, stats, matched)
+
+    def match(self, pats, tree, item, order=None, trace=None, metrics=None, groupname=None):
+        """Evaluate the rules of one group without changing the tree.
+
+        Returns (unique, optional) when every mandatory rule matched,
+        otherwise None. order is the DocumentOrder of the page, which is
+        shared by every group and fragment of the page. If trace is a list
+        failure messages are added to it instead of being logged. If
+        metrics is a dict each rule's evaluations, hits and time are added
+        to it under 'rules' by 'groupname-field'.
+        """
+        rules = None if metrics is None else metrics.setdefault('rules', {})
+        def log(level, msg, *args):
+            if not self.logger.isEnabledFor(level):
+                return
+            if trace is None:
+                self.logger.log(level, msg, *args)
+            else:
+                trace.append((level, msg, args))
         unique = OrderedDict()
         nomatch = []
         optional = []
@@ -282,36 +637,62 @@ class TemplateFinder(object):
             for format, xp in xps:
                 if format.lower() == 'tal':
                     continue
-                if xp.strip().lower().endswith('/text()'):
-                    #treat special so normal node ops still work
-                    xp = xp.strip()[:-7]
-                    if format.lower().endswith('html'):
-                        format = format.lower()[:-4] + 'text'
-                    elif format.lower().startswith('optional'):
-                        format = 'optionaltext'
-                nodes = tree.xpath(xp, namespaces=ns)
+                # rules are precompiled in __init__, see compileRule
+                start = time.time()
+                nodes = xp(tree)
+                if rules is not None:
+                    rule = rules.setdefault('%s-%s' % (groupname, field),
+                                            {'count': 0, 'hits': 0, 'seconds': 0.0})
+                    rule['count'] += 1
+                    rule['hits'] += bool(nodes)
+                    rule['seconds'] += time.time() - start
                 if not nodes:
                     if format.lower().startswith('optional'):
-                        optional.append((field, xp))
+                        optional.append((field, xp.path))
                     else:
-                        nomatch.append((field, xp))
-                        self.logger.debug("FAIL %s:%s=%s %s\n%s" % (item['_path'],
-                                                        field, format, xp,
-                                                        etree.tostring(tree, method='html', encoding=unicode)))
+                        nomatch.append((field, xp.path))
+                        log(logging.DEBUG, "FAIL %s:%s=%s %s\n%s", item['_path'],
+                            field, format, xp.path, LazyHTML(tree))
                         continue
 
                 nodes = [(format, n) for n in nodes]
-                unique[field] = nonoverlap(unique.setdefault(field, []), nodes)
+                unique[field] = nonoverlap(unique.setdefault(field, []), nodes, order)
         if nomatch:
             matched = [field for field in unique.keys()]
             unmatched = [field for field, xp in nomatch]
-            self.logger.info("FAIL: '%s' matched=%s, unmatched=%s" % (item['_path'],
-                                                             matched, unmatched))
-            return False
+            log(logging.INFO, "FAIL: '%s' matched=%s, unmatched=%s", item['_path'],
+                matched, unmatched)
+            return None
+        return unique, optional
+
+    def apply(self, pats, tree, item, stats, matched, tal=True):
+        """Remove the nodes matched by the winning group from the tree and
+        update item with the extracted fields.
+        """
+        unique, optional = matched
+        start = time.time()
+        extracted = self.dropNodes(unique)
+        remainder = self.remainder(tree)
+        metricutils.timed(self.metrics, 'serialize', start)
+        return self.update(pats, item, stats, unique.keys(), optional, extracted, remainder, tal)
+
+    def applyPending(self, item, fields, groupname):
+        """Set the fields kept for a streamed item once it arrives then run
+        the TAL rules of the group that extracted them.
+        """
+        remainder = fields.pop(self.template_key, NOTSET)
+        item.update(fields)
+        self.evaluateTal(self.groups[groupname], item)
+        if remainder is not NOTSET:
+            item[self.template_key] = remainder
+
+    def dropNodes(self, unique):
+        """Pull the matched nodes out of the tree and return their content
+        by field.
+        """
         extracted = {}
         assert unique
         # we will pull selected nodes out of tree so data isn't repeated
-
         for field, nodes in unique.items():
             toremove = []
             for format, node in nodes:
@@ -324,7 +705,7 @@ class TemplateFinder(object):
                 try:
                     node.drop_tree()
                 except:
-                    self.logger.error("error in drop_tree %s=%s" % (field, etree.tostring(node, method='html', encoding=unicode)))
+                    self.logger.error("error in drop_tree %s=%s", field, LazyHTML(node))
             for node in toremove:
                 nodes.remove(node)
 
@@ -344,7 +725,7 @@ class TemplateFinder(object):
                         extracted[field] += value
                 else:
                     extracted[field] += etree.tostring(node, method='html', encoding=unicode)
-                self.logger.debug("EXTRACTED: %s=%s" % (field, extracted[field]))
+                self.logger.debug("EXTRACTED: %s=%s", field, extracted[field])
         # What was this code for?
         #for field, nodes in unique.items():
         #    for format, node in nodes:
@@ -353,9 +734,36 @@ class TemplateFinder(object):
         #            lxml.html.fragment_fromstring(html)
         #        except lxml.etree.ParserError:
         #            extracted[field] = html
+        return extracted
+
+    def remainder(self, tree):
+        """The html left once the matched nodes have been removed, unless
+        acting as a filter.
+        """
+        if self.act_as_filter:
+            return None
+        return etree.tostring(tree, method='html', encoding=unicode)
 
+    def update(self, pats, item, stats, fields, optional, extracted, remainder, tal=True):
+        """Set the extracted fields on item then run the TAL rules"""
         item.update(extracted)
+        if tal:
+            self.evaluateTal(pats, item)
+
+        unmatched = set([field for field, xp in optional])
+        matched = set(fields) - set(unmatched)
+        for field in matched:
+            stats[field] = stats.get(field, 0) + 1
+        self.logger.info("PASS: '%s' matched=%s, unmatched=%s", item['_path'], list(matched), list(unmatched))
+        if '_tree' in item:
+            del item['_tree']
+        if remainder is not None:
+            item[self.template_key] = remainder
+
+        return item
 
+    def evaluateTal(self, pats, item):
+        """Run the group's TAL rules and the tal option against item"""
         #match tal format
         extracted = {}
         for field, xps in pats.items():
@@ -369,24 +777,12 @@ class TemplateFinder(object):
                 except Exception, e:
                     raise TALException("%s tal caused %s"% (field,str(e))), None, sys.exc_info()[2]
                 extracted[field] = extracted.get(field, '') + value
-                self.logger.debug("EXTRACTED: %s=%s" % (field, extracted[field]))
+                self.logger.debug("EXTRACTED: %s=%s", field, extracted[field])
         for field, tal in self.tal:
             value = tal(item, re=re)
             extracted[field] = value
         item.update(extracted)
 
-        unmatched = set([field for field, xp in optional])
-        matched = set(unique.keys()) - set(unmatched)
-        for field in matched:
-            stats[field] = stats.get(field, 0) + 1
-        self.logger.info("PASS: '%s' matched=%s, unmatched=%s", item['_path'], list(matched), list(unmatched))
-        if '_tree' in item:
-            del item['_tree']
-        if not self.act_as_filter:
-            item[self.template_key] = etree.tostring(tree, method='html', encoding=unicode)
-
-        return item
-
     def getHtml(self, item):
         """Return the right html content based on attribute and mimetype"""
         path = item.get('_path', None)
@@ -408,7 +804,204 @@ def ancestors(e):
         yield n
 
 
-def nonoverlap(unique, new):
+class DocumentOrder(object):
+    """Pre-order intervals for the elements of a tree.
+
+    Each element gets (first, last) where first is its position in document
+    order and last is the position of its last descendant, so an element is
+    an ancestor of another when the other's first falls inside its interval.
+    The intervals are only worked out the first time they are needed.
+    """
+
+    def __init__(self, tree):
+        self.root = tree.getroottree().getroot()
+        self._intervals = None
+
+    @property
+    def intervals(self):
+        if self._intervals is None:
+            intervals = {}
+            stack = []
+            pos = -1
+            for pos, node in enumerate(self.root.iter()):
+                parent = node.getparent()
+                while stack and stack[-1][0] is not parent:
+                    e, first = stack.pop()
+                    intervals[e] = (first, pos - 1)
+                stack.append((node, pos))
+            for e, first in stack:
+                intervals[e] = (first, pos)
+            self._intervals = intervals
+        return self._intervals
+
+
+class PageSignature(object):
+    """The tag names, ids and class attributes found in a page, collected in
+    one pass the first time a group signature is checked against it.
+    """
+
+    def __init__(self, tree):
+        self.root = tree.getroottree().getroot()
+        self._found = None
+
+    def missing(self, signature):
+        """Describe the first part of signature not in the page, or None"""
+        if self._found is None:
+            tags, ids, classes = set(), set(), set()
+            for node in self.root.iter():
+                if not isinstance(node.tag, basestring):
+                    # comments and processing instructions
+                    continue
+                tags.add(node.tag)
+                value = node.get('id')
+                if value is not None:
+                    ids.add(value)
+                value = node.get('class')
+                if value is not None:
+                    classes.add(value)
+            self._found = (tags, ids, classes)
+        for kind, needed, found in zip(('tag', 'id', 'class'), signature, self._found):
+            absent = needed - found
+            if absent:
+                return "%s %s" % (kind, ', '.join(sorted(absent)))
+        return None
+
+
+# a location path once predicates are taken out, optionally ending in a node test
+SIMPLE_PATH = re.compile(r'^[\w\-.:/@*]*(?:(?:text|node|comment)\(\))?$')
+STEP = re.compile(r'^(?:([a-z-]+)::)?([a-zA-Z_][\w.-]*)$')
+# axes whose name test is a tag, unlike attribute:: and namespace::
+ELEMENT_AXES = frozenset(['child', 'descendant', 'descendant-or-self', 'self', 'parent',
+                          'ancestor', 'ancestor-or-self', 'following', 'following-sibling',
+                          'preceding', 'preceding-sibling'])
+# strings, names, space and single characters of a predicate
+PREDICATE_TOKEN = re.compile(r'''"[^"]*"|'[^']*'|[\w.:-]+|\s+|.''')
+ATTR_EQUALS = re.compile(r'''^\s*@(id|class)\s*=\s*(?:"([^"]*)"|'([^']*)')\s*$''')
+
+def conjuncts(predicate):
+    """Split predicate at its top level 'and's, or return [] if it has a
+    top level 'or' as then none of its parts has to hold."""
+    parts = ['']
+    depth = 0
+    for token in PREDICATE_TOKEN.findall(predicate):
+        if token in '([':
+            depth += 1
+        elif token in ')]':
+            depth -= 1
+        elif depth == 0 and token == 'or':
+            return []
+        elif depth == 0 and token == 'and':
+            parts.append('')
+            continue
+        parts[-1] += token
+    return parts
+
+def ruleSignature(xp):
+    """Return (tags, ids, classes) a page must contain for the XPath xp to
+    select anything, or None if xp is more than a simple location path.
+
+    Tags come from the steps of the path on element axes. Ids and classes
+    only come from predicates of the steps that are, or are and-ed with,
+    @id or @class compared to a string. Anything inside functions such as
+    not() or count(), or or-ed, could hold without them.
+    """
+    outside = ''
+    predicates = []
+    depth = 0
+    quote = None
+    for c in xp:
+        if quote is None and c == '[':
+            depth += 1
+            if depth == 1:
+                predicates.append('')
+                continue
+        elif quote is None and c == ']':
+            depth -= 1
+            if depth == 0:
+                continue
+        elif c == quote:
+            quote = None
+        elif quote is None and c in '"\'':
+            quote = c
+        if depth:
+            predicates[-1] += c
+        else:
+            outside += c
+    if depth or quote or not SIMPLE_PATH.match(outside):
+        return None
+    tags = set()
+    for step in outside.split('/'):
+        m = STEP.match(step)
+        if m is not None and (m.group(1) is None or m.group(1) in ELEMENT_AXES):
+            tags.add(m.group(2))
+    ids, classes = set(), set()
+    for predicate in predicates:
+        for part in conjuncts(predicate):
+            m = ATTR_EQUALS.match(part)
+            if m is None:
+                continue
+            name, double, single = m.groups()
+            if name == 'id':
+                ids.add(double or single)
+            else:
+                classes.add(double or single)
+    return tags, ids, classes
+
+
+# below this many nodes the simple pairwise check is quicker than the sweep
+NONOVERLAP_MIN = 16
+
+def nonoverlap(unique, new, order=None):
+    """Return the elements which aren't descentants of each other
+
+    Gives the same result as simple_nonoverlap but when a DocumentOrder is
+    given, all the nodes are elements and there are enough of them, the
+    ancestor tests are done on intervals with a single sweep in document
+    order rather than comparing every pair.
+    """
+    if order is None or len(unique) + len(new) < NONOVERLAP_MIN:
+        return simple_nonoverlap(unique, new)
+    intervals = order.intervals
+    # key each element on where it will end up in the list. An element
+    # from new is appended again each time it appears so its last
+    # appearance wins.
+    candidates = {}
+    for key, (format, e) in enumerate(unique + list(new)):
+        if e not in intervals:
+            # text results or nodes from another tree
+            return simple_nonoverlap(unique, new)
+        candidates[e] = (key, format)
+    # the result is the outermost elements, in order of their keys
+    result = []
+    last = -1
+    for e in sorted(candidates, key=lambda e: intervals[e][0]):
+        first, end = intervals[e]
+        if first > last:
+            key, format = candidates[e]
+            result.append((key, (format, e)))
+            last = end
+    result.sort()
+    unique[:] = [pair for key, pair in result]
+    return unique
+
+
+# the TemplateFinder behind each iterator of items, so the section after it
+# in the pipeline can find it
+UPSTREAM = weakref.WeakKeyDictionary()
+
+# sections using workers by name. Workers are forked from the pipeline so
+# they find their section here
+WORKER_SECTIONS = {}
+
+def extractInWorker(name, path, content):
+    result, tried, skipped, trace, metrics = WORKER_SECTIONS[name].extractPage(path, content)
+    # the tree stays in the worker so the html in the trace is needed now
+    trace = [(level, msg, tuple(unicode(a) if isinstance(a, LazyHTML) else a for a in args))
+             for level, msg, args in trace]
+    return result, tried, skipped, trace, metrics
+
+
+def simple_nonoverlap(unique, new):
     """Return the elements which aren't descentants of each other"""
     for format, e1 in new:
         #if e1 is an ascendant then replace
@@ -110,6 +110,827 @@ flags = optionflags = doctest.ELLIPSIS | doctest.REPORT_ONLY_FIRST_FAILURE | \
 #
 #    ))
 #    return suite
+
+
+class FixtureTestCase(unittest.TestCase):
+    """Gives each test a temporary directory, self.tmp, and patch() to
+    replace an attribute until the test ends, whether it passes or not"""
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, obj.__dict__[name])
+        setattr(obj, name, value)
+
+
+class RulePathTests(unittest.TestCase):
+    """A group's path is matched against _path as it is, never compiled"""
+
+    def testPathIsNotXPath(self):
+        from transmogrify.htmlcontentextractor.templatefinder import TemplateFinder
+        def items():
+            for path in ('news/2012?id=3', 'about us.html'):
+                yield dict(_site_url='http://test.com/', _path=path,
+                           text='<html><body><h1>One</h1><h2>Two</h2></body></html>')
+        options = {'rules': '1-path = news/2012?id=3\n1-title = //h1/text()\n'
+                            '2-title = //h2/text()'}
+        section = TemplateFinder(None, 'template', options, items())
+        self.assertEqual(section.groups[1]['path'], 'news/2012?id=3')
+        found = dict((item['_path'], item['title']) for item in section)
+        self.assertEqual(found, {'news/2012?id=3': 'One', 'about us.html': 'Two'})
+
+
+class NonOverlapTests(unittest.TestCase):
+    """nonoverlap must give exactly the same result as simple_nonoverlap"""
+
+    def randomTree(self, rnd, size):
+        import lxml.html
+        root = lxml.html.fromstring('<div></div>')
+        nodes = [root]
+        comments = []
+        for i in range(size):
+            parent = rnd.choice(nodes)
+            e = lxml.html.Element(rnd.choice(['p', 'div', 'span']))
+            parent.append(e)
+            nodes.append(e)
+            if rnd.random() < 0.1:
+                comment = lxml.html.HtmlComment('comment')
+                parent.append(comment)
+                comments.append(comment)
+        return root, nodes + comments
+
+    def testSameAsSimple(self):
+        import random
+        from transmogrify.htmlcontentextractor.templatefinder import \
+            nonoverlap, simple_nonoverlap, DocumentOrder
+        rnd = random.Random(0)
+        for trial in range(500):
+            root, nodes = self.randomTree(rnd, rnd.randint(1, 60))
+            order = DocumentOrder(root)
+            expected, got = [], []
+            for rule in range(rnd.randint(1, 4)):
+                new = [(rnd.choice(['html', 'text']), rnd.choice(nodes))
+                       for i in range(rnd.randint(0, 30))]
+                expected = simple_nonoverlap(expected, list(new))
+                got = nonoverlap(got, list(new), order)
+                self.assertEqual(expected, got)
+
+    def testTextResults(self):
+        import lxml.html
+        from transmogrify.htmlcontentextractor.templatefinder import \
+            nonoverlap, simple_nonoverlap, DocumentOrder
+        root = lxml.html.fromstring('<div>%s</div>' % ('<p>a<b>b</b></p>' * 20))
+        new = [('text', n) for n in root.xpath('//p/text()|//b/text()|//p')]
+        self.assertEqual(simple_nonoverlap([], list(new)),
+                         nonoverlap([], list(new), DocumentOrder(root)))
+
+
+class SignatureTests(unittest.TestCase):
+    """A group signature must never rule out a page its rules match"""
+
+    def testRuleSignature(self):
+        from transmogrify.htmlcontentextractor.templatefinder import ruleSignature
+        self.assertEqual(ruleSignature("//div[@id='content']/p"),
+                         (set(['div', 'p']), set(['content']), set()))
+        self.assertEqual(ruleSignature('//div[@class="a b"][1]//span/text()'),
+                         (set(['div', 'span']), set(), set(['a b'])))
+        self.assertEqual(ruleSignature("//div[not(@id='x')]"),
+                         (set(['div']), set(), set()))
+        self.assertEqual(ruleSignature("//div[@id='x' or @id='y']"),
+                         (set(['div']), set(), set()))
+        self.assertEqual(ruleSignature("./following-sibling::td[re:test(@class, 'x')]"),
+                         (set(['td']), set(), set()))
+        self.assertEqual(ruleSignature('//a/attribute::href'), (set(['a']), set(), set()))
+        self.assertEqual(ruleSignature('//a/@href'), (set(['a']), set(), set()))
+        self.assertEqual(ruleSignature('//div/namespace::xml'), (set(['div']), set(), set()))
+        self.assertEqual(ruleSignature('//td/ancestor::table/child::tr'),
+                         (set(['td', 'table', 'tr']), set(), set()))
+        self.assertEqual(ruleSignature("//div[count(p[@class='a'])=0]"), (set(['div']), set(), set()))
+        self.assertEqual(ruleSignature("//div[not(@class='a') and @id='b']"),
+                         (set(['div']), set(['b']), set()))
+        self.assertEqual(ruleSignature("//div[@id='a' and (@class='b' or @class='c')]"),
+                         (set(['div']), set(['a']), set()))
+        self.assertEqual(ruleSignature("//div[@class='a' and position()=1][@id=\"b or c\"]"),
+                         (set(['div']), set(['b or c']), set(['a'])))
+        self.assertEqual(ruleSignature("//div[p/@class='a']"), (set(['div']), set(), set()))
+        self.assertEqual(ruleSignature("//div[@class='a']='x'"), None)
+        self.assertEqual(ruleSignature("//h1|//h2"), None)
+        self.assertEqual(ruleSignature("string(//h1)"), None)
+
+    def testNeverSkipsAMatch(self):
+        import random
+        import lxml.html
+        from lxml import etree
+        from transmogrify.htmlcontentextractor.templatefinder import \
+            ruleSignature, PageSignature, ns
+        rnd = random.Random(0)
+        tags = ['p', 'div', 'span']
+        values = ['a', 'b', 'a b']
+        for trial in range(200):
+            root = lxml.html.fromstring('<div></div>')
+            nodes = [root]
+            for i in range(rnd.randint(1, 30)):
+                e = lxml.html.Element(rnd.choice(tags))
+                if rnd.random() < 0.3:
+                    e.set(rnd.choice(['id', 'class']), rnd.choice(values))
+                rnd.choice(nodes).append(e)
+                nodes.append(e)
+            for rule in range(10):
+                xp = rnd.choice(['', '.'])
+                for step in range(rnd.randint(1, 3)):
+                    xp += rnd.choice(['//', '/']) + rnd.choice(tags + ['*'])
+                    if rnd.random() < 0.5:
+                        xp += rnd.choice(["[@id='%s']", '[@class="%s"]',
+                                          "[not(@id='%s')]", "[count(p[@class='%s'])=0]",
+                                          "[@id='a' or @class='%s']"]) % rnd.choice(values)
+                if rnd.random() < 0.3:
+                    xp += rnd.choice(['/attribute::id', '/@class'])
+                signature = ruleSignature(xp)
+                if etree.XPath(xp, namespaces=ns)(root):
+                    self.assertEqual(PageSignature(root).missing(signature), None, xp)
+
+
+class ClusteringTests(unittest.TestCase):
+    """Pruning in LayoutAnalyzer.analyze must find the same clusters"""
+
+    def site(self, rnd, pages):
+        from transmogrify.htmlcontentextractor.webstemmer.htmldom import parse
+        words = 'alpha beta gamma delta epsilon zeta eta theta iota kappa'.split()
+        def text(n):
+            return ' '.join(rnd.choice(words) for i in range(n))
+        site = []
+        for i in range(pages):
+            # templates share some sections so pages are more or less alike
+            sections = ''.join('<div class="s%d"><p>%s</p></div>' % (s, text(rnd.randint(3, 30)))
+                               for s in range(6) if rnd.random() < 0.7)
+            html = '<html><head><title>%s</title></head><body>%s</body></html>' % (text(3), sections)
+            site.append(('site/%d' % i, parse(html, charset='utf-8')))
+        return site
+
+    def testSameAsUnpruned(self):
+        import random
+        from transmogrify.htmlcontentextractor.webstemmer.analyze import \
+            LayoutAnalyzer, find_clusters, sim_upperbound
+        rnd = random.Random(0)
+        for trial in range(10):
+            site = self.site(rnd, 20)
+            for threshold in (0.5, 0.8, 0.97):
+                found = []
+                for prune in (True, False):
+                    analyzer = LayoutAnalyzer(prune=prune)
+                    for name, tree in site:
+                        analyzer.add_tree(name, tree)
+                    clusters = analyzer.analyze(threshold, verbose=False)
+                    found.append(sorted(sorted(p.name for p in c.pages) for c in clusters))
+                self.assertEqual(found[0], found[1])
+            pages = analyzer.pages.values()
+            for page1 in pages:
+                for page2 in pages:
+                    layout = find_clusters([page1.blocks, page2.blocks])
+                    sim = sum(c.weight for c in layout) / max(float(page1.weight + page2.weight), 1)
+                    self.assertTrue(sim <= sim_upperbound(page1, page2))
+
+
+    def testWithoutText(self):
+        import random
+        from transmogrify.htmlcontentextractor.webstemmer.analyze import LayoutAnalyzer
+        site = self.site(random.Random(2), 20)
+        found = []
+        for keep_text in (True, False):
+            analyzer = LayoutAnalyzer(keep_text=keep_text)
+            for name, tree in site:
+                analyzer.add_tree(name, tree)
+            clusters = analyzer.analyze(0.8, verbose=False)
+            found.append([(c.name, c.score, c.pattern) for c in clusters])
+        self.assertEqual(found[0], found[1])
+        for page in analyzer.pages.values():
+            for block in page.blocks:
+                self.assertEqual(block.orig_text, None)
+
+
+class ClusterSeqTests(unittest.TestCase):
+    """cluster_seq_keys must give exactly the same clusters as cluster_seq"""
+
+    def testSameAsClusterSeq(self):
+        import random
+        from transmogrify.htmlcontentextractor.webstemmer import layoutils
+        if layoutils.numpy is None:
+            self.skipTest('numpy is not installed')
+        rnd = random.Random(0)
+        for trial in range(2000):
+            # few distinct keys so there are plenty of ties
+            keys = rnd.randint(1, 6)
+            s1 = [rnd.randint(0, keys) for i in range(rnd.randint(0, 20))]
+            s2 = [rnd.randint(0, keys) for i in range(rnd.randint(0, 20))]
+            objects = [object() for key in s2]
+            expected = layoutils.cluster_seq(s1, range(len(s2)), lambda x, i: x == s2[i])
+            expected = [[objects[i] for i in group] for group in expected]
+            self.assertEqual(expected, layoutils.cluster_seq_keys(s1, s2, objects))
+
+    def testInternedPaths(self):
+        from transmogrify.htmlcontentextractor.webstemmer import layoutils
+        b1 = layoutils.TextBlock('div/p', 'some text', 'some text')
+        b2 = layoutils.TextBlock(''.join(['div', '/p']), 'more text', 'more text')
+        b3 = layoutils.TextBlock('td/p', 'other text', 'other text')
+        self.assertEqual(b1.pathid, b2.pathid)
+        self.assertTrue(b1.path is b2.path)
+        self.assertNotEqual(b1.pathid, b3.pathid)
+        self.assertEqual(layoutils.PATHS[b3.pathid], 'td/p')
+
+    def testRetrieveBlocks(self):
+        import random
+        from transmogrify.htmlcontentextractor.webstemmer import layoutils
+        if layoutils.numpy is None:
+            self.skipTest('numpy is not installed')
+        rnd = random.Random(1)
+        paths = ['div/p', 'div/h1', 'td/p', 'li', 'ul/li/a']
+        blocks = [layoutils.TextBlock(rnd.choice(paths), 'some text', 'some text')
+                  for i in range(300)]
+        pathseq = [rnd.choice(paths) for i in range(60)]
+        self.assertEqual(layoutils.cluster_seq(pathseq, blocks, lambda p, b: p == b.path),
+                         layoutils.retrieve_blocks(pathseq, blocks))
+
+
+class TextBlockTests(unittest.TestCase):
+    """get_textblocks must give the same blocks for an lxml tree as for htmldom"""
+
+    PAGES = [
+        '<html><head><title>Title</title></head><body><h1 class="description">My description</h1>'
+        '<p>Some <a href="link">text</a></p></body></html>',
+        '<html><body><div id="main"><!-- comment --><p>One<br>two</p><ul><li>a</li><li>b</li></ul>'
+        '<p><img alt="T">he drop cap</p></div><table><tr><td>cell</td></tr></table></body></html>',
+        '<div class="s1"><h3>Section</h3><p>loose <b>bold</b> tail</p></div>text after',
+        ]
+
+    def testSameAsHtmldom(self):
+        import lxml.html
+        from transmogrify.htmlcontentextractor.webstemmer.htmldom import parse
+        from transmogrify.htmlcontentextractor.webstemmer.layoutils import get_textblocks
+        for html in self.PAGES:
+            expected = [(b.path, b.orig_text) for b in get_textblocks(parse(html, charset='utf-8'))]
+            found = [(b.path, b.orig_text) for b in get_textblocks(lxml.html.document_fromstring(html))]
+            self.assertEqual(expected, found, html)
+
+    # unclosed p around block tags, which htmlparser3 ends and libxml2 doesn't
+    MALFORMED = [
+        '<html><body><p>Intro text<a name=x><hr><h3>The heading</h3><p>Para text</body></html>',
+        '<div id="main"><p>Some text <span>in a span<div>a block</div> after it</span> tail</p></div>',
+        '<p>One <b>bold<table><tr><td>a cell</td></tr></table> more</b> text<p>Next para</p>',
+        ]
+
+    def testImpliedEndTags(self):
+        import lxml.html
+        from transmogrify.htmlcontentextractor.webstemmer.htmldom import parse
+        from transmogrify.htmlcontentextractor.webstemmer.layoutils import get_textblocks
+        for html in self.MALFORMED:
+            expected = [(b.path, b.orig_text) for b in get_textblocks(parse(html, charset='utf-8'))]
+            found = [(b.path, b.orig_text) for b in get_textblocks(lxml.html.document_fromstring(html))]
+            self.assertEqual(expected, found, html)
+        blocks = get_textblocks(lxml.html.document_fromstring(self.MALFORMED[0]))
+        self.assertEqual([b.path for b in blocks], ['p', 'h3', 'p'])
+
+    def testWithoutStyles(self):
+        from transmogrify.htmlcontentextractor.webstemmer.htmldom import parse
+        from transmogrify.htmlcontentextractor.webstemmer.layoutils import get_textblocks
+        from transmogrify.htmlcontentextractor.webstemmer.style import StyleSheet
+        css = '<style>p { font-size: 12px } div#main { width: 80% }</style>'
+        for html in self.PAGES:
+            html = css + html
+            styled = parse(html, charset='utf-8', stylesheet=StyleSheet())
+            tree = parse(html, charset='utf-8', stylesheet=StyleSheet(), styles=False)
+            self.assertEqual([(b.path, b.orig_text) for b in get_textblocks(styled)],
+                             [(b.path, b.orig_text) for b in get_textblocks(tree)])
+            for (depth, e) in tree.walk():
+                if not isinstance(e, basestring):
+                    self.assertEqual(e['_style'], None)
+
+
+class DiffScoreTests(unittest.TestCase):
+    """Sampled diffscores must stay close to the exact ones"""
+
+    def section(self, rnd, pages):
+        from transmogrify.htmlcontentextractor.webstemmer.analyze import LayoutSectionCluster
+        from transmogrify.htmlcontentextractor.webstemmer.layoutils import TextBlock
+        words = 'alpha beta gamma delta epsilon zeta eta theta iota kappa'.split()
+        # some pages share their text so the score isn't just that of random text
+        shared = ''.join(rnd.choice(words) for i in range(20))
+        blockgroups = []
+        for i in range(pages):
+            text = ''.join(rnd.choice(words) for i in range(rnd.randint(0, 20)))
+            if rnd.random() < 0.5:
+                text = shared + text
+            blockgroups.append([TextBlock('div/p', text, text)])
+        return LayoutSectionCluster(0, blockgroups)
+
+    def testSampled(self):
+        import random
+        from transmogrify.htmlcontentextractor.webstemmer.analyze import diff_samples
+        rnd = random.Random(0)
+        samples = diff_samples(0.05, 0.999)
+        for trial in range(3):
+            sect = self.section(rnd, 100)
+            sect.calc_diffscore()
+            exact = sect.diffscore
+            sect.calc_diffscore(0.05, 0.999)
+            self.assertTrue(abs(sect.diffscore - exact) <= 0.05, (sect.diffscore, exact))
+        # clusters with fewer pairs than samples are scored exactly
+        sect = self.section(rnd, 20)
+        self.assertTrue(20*19/2 < samples)
+        sect.calc_diffscore()
+        exact = sect.diffscore
+        sect.calc_diffscore(0.05, 0.999)
+        self.assertEqual(sect.diffscore, exact)
+
+    def testDefaults(self):
+        from transmogrify.htmlcontentextractor.webstemmer.analyze import LayoutAnalyzer
+        from transmogrify.htmlcontentextractor.autofinder import AutoFinder
+        # only the auto blueprint samples unless asked to
+        self.assertEqual(LayoutAnalyzer().diff_error, 0)
+        self.assertEqual(AutoFinder(None, 'auto', {}, iter([])).diff_error, 0.05)
+
+
+class PatternStoreTests(FixtureTestCase):
+    """AutoFinder must reuse saved layouts without clustering again"""
+
+    def items(self):
+        import random
+        rnd = random.Random(0)
+        words = 'alpha beta gamma delta epsilon zeta eta theta iota kappa'.split()
+        def text(n):
+            return ' '.join(rnd.choice(words) for i in range(n))
+        for i in range(10):
+            html = ('<html><head><title>%s</title></head><body><div id="header"><h1>Site</h1></div>'
+                    '<div id="content"><h2>%s</h2><p>%s</p><p>%s</p></div></body></html>'
+                    % (text(3), text(4), text(40), text(40)))
+            yield dict(_site_url='http://test.com/', _path='p%d' % i, text=html,
+                       _mimetype='text/html')
+
+    def extract(self, **options):
+        from transmogrify.htmlcontentextractor.autofinder import AutoFinder
+        return [sorted(item.items()) for item in AutoFinder(None, 'auto', options, self.items())]
+
+    def testReuse(self):
+        import os
+        from transmogrify.htmlcontentextractor.webstemmer.analyze import LayoutAnalyzer
+        patterns = os.path.join(self.tmp, 'patterns.json')
+        expected = self.extract(patterns=patterns)
+        self.assertTrue(os.path.exists(patterns))
+        def clustered(*args, **kw):
+            raise AssertionError('clustered again')
+        self.patch(LayoutAnalyzer, 'analyze', clustered)
+        self.assertEqual(self.extract(patterns=patterns), expected)
+        # other settings can't use them
+        self.assertRaises(AssertionError, self.extract, patterns=patterns, patterns_version='2')
+
+    def testBroken(self):
+        import os
+        import json
+        patterns = os.path.join(self.tmp, 'patterns.json')
+        expected = self.extract(patterns=patterns)
+        with open(patterns) as fp:
+            data = fp.read()
+        saved = json.loads(data)
+        broken = [data[:len(data) // 2], '[1, 2]']
+        for change in (lambda s: s.pop('patterns'),
+                       lambda s: s.__setitem__('mangle_pat', 42),
+                       lambda s: s['patterns'][0].pop('score'),
+                       lambda s: s['patterns'][0].__setitem__('pattern', [[0.5, 4.0]]),
+                       lambda s: s['patterns'][0].__setitem__('pattern', [[0.5, 4.0, ['p']]])):
+            copy = json.loads(data)
+            change(copy)
+            broken.append(json.dumps(copy))
+        for text in broken:
+            with open(patterns, 'w') as fp:
+                fp.write(text)
+            # learnt again and saved over the broken file
+            self.assertEqual(self.extract(patterns=patterns), expected, text)
+            self.assertEqual(json.load(open(patterns))['fingerprint'], saved['fingerprint'])
+
+    def testNoEval(self):
+        from StringIO import StringIO
+        from transmogrify.htmlcontentextractor.webstemmer.extract import LayoutPatternSet
+        patternset = LayoutPatternSet()
+        patternset.read(StringIO("(100.0, 'p1', 0, [(0.5, 4.0, 'title'), (0.9, 300.0, 'div/p')])"))
+        self.assertEqual(patternset.pats[0].pattern, [(0.5, 4.0, 'title'), (0.9, 300.0, 'div/p')])
+        self.assertRaises(ValueError, patternset.read, StringIO("__import__('os').getcwd()"))
+
+    def testAnalyzeOutput(self):
+        import os
+        from transmogrify.htmlcontentextractor.autofinder import AutoFinder
+        # paths as analyze.py learns them, from pages parsed by htmldom
+        patterns = os.path.join(self.tmp, 'analyze.txt')
+        with open(patterns, 'w') as fp:
+            fp.write("(100.0, 'p0', 1, [(0.5, 4.0, 'p'), (0.9, 10.0, 'h3'), (0.9, 300.0, 'p')])\n")
+        # an unclosed p that htmlparser3 ends at the hr
+        html = ('<html><head><title>Page</title></head><body><p>Intro %d<a name=x><hr>'
+                '<h3>Heading %d</h3><p>%s</body></html>')
+        items = [dict(_site_url='http://test.com/', _path='p%d' % i, _mimetype='text/html',
+                      text=html % (i, i, ' '.join(['para %d' % i] * 20))) for i in range(3)]
+        finder = AutoFinder(None, 'auto', {'patterns': patterns}, items)
+        extracted = list(finder)
+        self.assertTrue(finder.htmldom_patterns)
+        self.assertEqual([item['title'].strip() for item in extracted],
+                         ['Heading 0', 'Heading 1', 'Heading 2'])
+        for item in extracted:
+            self.assertTrue('para %s' % item['_path'][1:] in item['text'], item['text'])
+
+
+class IdentifyLayoutTests(unittest.TestCase):
+    """The pattern index must pick the same layout as trying every pattern"""
+
+    def testSameAsEveryPattern(self):
+        import random
+        from transmogrify.htmlcontentextractor.webstemmer.htmldom import parse
+        from transmogrify.htmlcontentextractor.webstemmer.layoutils import get_textblocks
+        from transmogrify.htmlcontentextractor.webstemmer.extract import \
+            LayoutPatternSet, LayoutPattern
+        rnd = random.Random(0)
+        words = 'alpha beta gamma delta epsilon zeta eta theta iota kappa'.split()
+        paths = ['title', 'div:class=s0/p', 'div:class=s1/p', 'div:class=s2/h2',
+                 'div:class=s3/p', 'div:class=s4/ul/li', 'div:class=s5/p']
+        for trial in range(200):
+            patternset = LayoutPatternSet()
+            for patno in range(rnd.randint(0, 8)):
+                pattern = [(0.5, 10.0, path) for path in paths if rnd.random() < 0.5]
+                patternset.pats.append(LayoutPattern('p%d' % patno, 100, 0, -1, pattern))
+            sections = ''.join('<div class="s%d"><p>%s</p><h2>%s</h2><ul><li>%s</li></ul></div>'
+                               % (i, ' '.join(rnd.sample(words, rnd.randint(1, 8))),
+                                  rnd.choice(words), rnd.choice(words))
+                               for i in range(6) if rnd.random() < 0.7)
+            tree = parse('<html><head><title>%s</title></head><body>%s</body></html>'
+                         % (rnd.choice(words), sections), charset='utf-8')
+            for strict in (True, False):
+                threshold = rnd.choice([0, 0.3, 0.8])
+                blocks = get_textblocks(tree)
+                (expected, max_weight) = (None, sum(b.weight for b in blocks) * threshold)
+                for pat1 in patternset.pats:
+                    layout = pat1.match_blocks(blocks, strict=strict)
+                    if layout and max_weight < sum(sect.weight for sect in layout):
+                        (expected, max_weight) = (pat1, sum(sect.weight for sect in layout))
+                (found, layout) = patternset.identify_layout(tree, threshold, strict=strict)
+                self.assertTrue(found is expected, (found, expected))
+
+
+class TokenizerTests(unittest.TestCase):
+    """The SGMLParser3 fast path must call the handlers as the state machine does"""
+
+    PIECES = ['<', '>', '/', '=', '"', "'", '&', ';', '#', 'amp', 'a', 'B', ' ', '\n', '-', '!',
+              '?', 'href', '<p>', '</p>', '<!--', '-->', '<script>', '</script>', '&#65;', '<br/>',
+              '<a href="x">', "<img src='y' alt=z>", '<!DOCTYPE html>', '<td nowrap>',
+              '<script type="text/javascript">']
+
+    def tokenize(self, html, fast):
+        from transmogrify.htmlcontentextractor.benchmarks.tokenizer import Recorder
+        parser = Recorder(fast)
+        for line in html.splitlines(True):
+            parser.feed(line)
+        return parser.calls
+
+    def testSameAsStateMachine(self):
+        import random
+        rnd = random.Random(0)
+        for trial in range(3000):
+            html = u''.join(rnd.choice(self.PIECES) for i in range(rnd.randint(1, 30)))
+            self.assertEqual(self.tokenize(html, True), self.tokenize(html, False), html)
+
+
+class StyleSheetTests(unittest.TestCase):
+    """Cached and indexed StyleSheet.lookup must give what checking every context does"""
+
+    PROPERTIES = ['color', 'background-color', 'font-size', 'font-weight', 'font-style',
+                  'text-align', 'width', 'height', 'margin-top', 'padding-left']
+
+    def expected(self, stylesheet, tags, contexts):
+        # StyleSheet.lookup without the index or cache
+        from transmogrify.htmlcontentextractor.webstemmer.style import Style
+        if not contexts:
+            (contexts1, contexts2) = ([''], set(['']))
+        else:
+            (contexts0, contexts1) = contexts
+            contexts2 = set(contexts0).union(contexts1)
+        (dic, new) = ({}, set())
+        for (c, tags1) in [(c, tags) for c in list(contexts2)] + [(c + '>', tags) for c in contexts1]:
+            for t in tags1:
+                if (c, t) in stylesheet.style:
+                    dic.update(stylesheet.style[(c, t)])
+                if (c, t) in stylesheet.state:
+                    if c:
+                        contexts2.discard(c)
+                    new.add(c + '/' + t)
+        style = None
+        if dic:
+            style = Style()
+            style.add_decl(dic)
+        return (style, contexts2, new)
+
+    def testSameAsEveryContext(self):
+        import random
+        from transmogrify.htmlcontentextractor.webstemmer.style import StyleSheet
+        rnd = random.Random(0)
+        tags = ['div', 'p', 'ul', 'li', 'td']
+        for trial in range(100):
+            # one property per rule so the order rules apply in doesn't matter
+            rules = []
+            for prop in rnd.sample(self.PROPERTIES, rnd.randint(1, len(self.PROPERTIES))):
+                sel = []
+                for i in range(rnd.randint(1, 3)):
+                    sel.append(rnd.choice(tags + ['*']) + rnd.choice(['', '.a', '#m']))
+                    if rnd.random() < 0.3:
+                        sel.append('>')
+                rules.append('%s { %s: 1px }' % (' '.join(sel).rstrip(' >'), prop))
+            stylesheet = StyleSheet()
+            stylesheet.parse(u' '.join(rules))
+            for page in range(3):
+                contexts = None
+                for depth in range(5):
+                    t = rnd.choice(tags)
+                    lookup = [u'', t] + rnd.choice([[], [u'.a', t + '.a']])
+                    (expected, contexts2, new) = self.expected(stylesheet, lookup, contexts)
+                    (style, contexts) = stylesheet.lookup(lookup, contexts)
+                    self.assertEqual(expected and expected.values, style and style.values)
+                    self.assertEqual(contexts, (contexts2, new))
+
+    def testCacheCleared(self):
+        from transmogrify.htmlcontentextractor.webstemmer.style import StyleSheet
+        stylesheet = StyleSheet()
+        stylesheet.parse(u'p { color: red }')
+        self.assertEqual(stylesheet.lookup([u'', 'p'])[0]['color'], u'red')
+        # the same rule again keeps the cache, a new one clears it
+        stylesheet.parse(u'p { color: red }')
+        self.assertEqual(stylesheet.lookup([u'', 'p'])[0]['color'], u'red')
+        stylesheet.parse(u'p { color: blue }')
+        self.assertEqual(stylesheet.lookup([u'', 'p'])[0]['color'], u'blue')
+
+
+class BenchmarkSuiteTests(unittest.TestCase):
+    """The benchmark site is the same for a seed and every phase sees every page"""
+
+    def testSameSite(self):
+        from transmogrify.htmlcontentextractor.benchmarks.sites import site
+        self.assertEqual(list(site(20, 3, seed=1)), list(site(20, 3, seed=1)))
+        self.assertNotEqual(list(site(20, 3, seed=1)), list(site(20, 3, seed=2)))
+
+    def testPhases(self):
+        from transmogrify.htmlcontentextractor.benchmarks import suite
+        context = {}
+        for phase in suite.PHASES:
+            timing = suite.run_phase(phase, 20, 2, 0, 20, context)
+            self.assertEqual(timing['pages'], 20, phase)
+            self.assert_(timing['bytes'] > 0, phase)
+        self.assertEqual(len(context['patternset'].pats), 2)
+
+
+class MetricsTests(FixtureTestCase):
+    """Sections count what they did and write it out at the end"""
+
+    def items(self):
+        yield dict(_site_url='http://test.com/', _path='a',
+                   text='<html><body><h1>A</h1><p>text</p></body></html>')
+        yield dict(_site_url='http://test.com/', _path='b',
+                   text='<html><body><h2>B</h2><p>text</p></body></html>')
+
+    def testTemplateFinder(self):
+        import os
+        import json
+        from transmogrify.htmlcontentextractor.templatefinder import TemplateFinder
+        path = os.path.join(self.tmp, 'metrics.json')
+        options = {'rules': '1-title = //h1/text()\n2-title = //h2/text()\n2-text = //p',
+                   'metrics': path}
+        section = TemplateFinder(None, 'template', options, self.items())
+        self.assertEqual(len(list(section)), 2)
+        metrics = section.metrics
+        self.assertEqual(metrics['items']['extracted'], 2)
+        self.assertEqual(metrics['parse']['count'], 2)
+        self.assertEqual(metrics['groups'][1], {'tried': 1, 'matched': 1, 'skipped': 1})
+        # group 2 is never tried for the page group 1 matched
+        self.assertEqual(metrics['groups'][2], {'tried': 1, 'matched': 1})
+        self.assertEqual((metrics['rules']['2-text']['count'], metrics['rules']['2-text']['hits']),
+                         (1, 1))
+        self.assertEqual(json.load(open(path))['items']['total'], 2)
+
+    def testPrometheus(self):
+        from transmogrify.htmlcontentextractor.metrics import prometheus
+        text = prometheus({'parse': {'count': 2, 'seconds': 0.5},
+                           'groups': {1: {'tried': 3}, 2: {'tried': 1}}}, 'template')
+        self.assertEqual(text.splitlines(), [
+            '# TYPE transmogrify_htmlcontentextractor_groups_tried untyped',
+            'transmogrify_htmlcontentextractor_groups_tried{section="template",group="1"} 3',
+            'transmogrify_htmlcontentextractor_groups_tried{section="template",group="2"} 1',
+            '# TYPE transmogrify_htmlcontentextractor_parse_count untyped',
+            'transmogrify_htmlcontentextractor_parse_count{section="template"} 2',
+            '# TYPE transmogrify_htmlcontentextractor_parse_seconds untyped',
+            'transmogrify_htmlcontentextractor_parse_seconds{section="template"} 0.5'])
+
+
+class ProgressTests(unittest.TestCase):
+    """Clustering reports progress a line at a time, throttled"""
+
+    def analyze(self, interval, verbose=True):
+        from transmogrify.htmlcontentextractor.webstemmer.analyze import LayoutAnalyzer, Progress
+        from transmogrify.htmlcontentextractor.webstemmer.htmldom import parse
+        from transmogrify.htmlcontentextractor.benchmarks.sites import site
+        lines = []
+        analyzer = LayoutAnalyzer(progress=Progress(lines.append, interval=interval))
+        for (name, html) in site(20, 2):
+            analyzer.add_tree(name, parse(html, charset='utf-8', styles=False))
+        analyzer.analyze(verbose=verbose)
+        return lines
+
+    def testThrottled(self):
+        lines = self.analyze(3600)
+        self.assertEqual(len(lines), 3)
+        self.assert_(lines[1].startswith('Clustering: 20/20 pages in '), lines[1])
+        self.assert_('comparisons/s' in lines[1], lines[1])
+        self.assert_(lines[2].startswith('Fixating: 2/2 clusters in '), lines[2])
+
+    def testEveryStep(self):
+        lines = self.analyze(0)
+        self.assert_(len(lines) > 20)
+        self.assert_([line for line in lines if 'eta' in line])
+
+    def testQuiet(self):
+        self.assertEqual(self.analyze(0, verbose=False), [])
+
+
+class AnchorTests(FixtureTestCase):
+    """Link text reaches each page once, whichever comes first"""
+
+    def page(self, links):
+        import lxml.html
+        return lxml.html.document_fromstring(
+            '<html><body><h1>Page</h1>%s</body></html>'
+            % ''.join('<a href="%s">%s</a>' % link for link in links))
+
+    def testIncremental(self):
+        from transmogrify.htmlcontentextractor.webstemmer.analyze import \
+            LayoutAnalyzer, PageFeeder, NullProgress
+        analyzer = LayoutAnalyzer(progress=NullProgress())
+        feeder = PageFeeder(analyzer)
+        feeder.add_anchor('http://s/b', 'Page B')
+        feeder.feed_tree('http://s/a', self.page([]))
+        feeder.add_anchor('http://s/a', 'Page A')
+        feeder.feed_tree('http://s/b', self.page([]))
+        feeder.add_anchor('http://s/a', 'Page A')
+        feeder.add_anchor('http://s/a', 'page  a')
+        feeder.add_anchor('http://s/c', 'Page C')
+        feeder.close()
+        self.assertEqual(analyzer.pages['http://s/a'].anchor_strs, ['pagea'])
+        self.assertEqual(analyzer.pages['http://s/b'].anchor_strs, ['pageb'])
+        self.assertEqual(feeder.dic.keys(), ['http://s/c'])
+
+    def testAutoFinder(self):
+        import lxml.html
+        from transmogrify.htmlcontentextractor.autofinder import AutoFinder
+        from transmogrify.htmlcontentextractor.webstemmer.analyze import LayoutAnalyzer, PageFeeder
+        self.assertEqual(list(AutoFinder(None, 'auto', {}, iter([])).anchors(
+            'http://s/x/a', self.page([('b#top', 'B'), ('/c', 'C'), ('#top', 'Top'),
+                                       ('mailto:a@s', 'Mail'), ('javascript:go()', 'Go'),
+                                       ('http://other/d', 'D'), ('ftp://s/e', 'E')]),
+            'http://s/')),
+            [('http://s/x/b', 'B'), ('http://s/c', 'C')])
+        def items():
+            for i in range(5):
+                html = lxml.html.tostring(self.page([('p%d' % ((i + 1) % 5), 'Title %d' % i)]))
+                yield dict(_site_url='http://s/', _path='p%d' % i, text=html,
+                           _mimetype='text/html')
+        seen = {}
+        closed = []
+        analyze, close = LayoutAnalyzer.analyze, PageFeeder.close
+        def analyzed(self, *args, **kw):
+            seen.update((name, p.anchor_strs) for (name, p) in self.pages.items())
+            return analyze(self, *args, **kw)
+        def closing(self):
+            closed.append(self)
+            return close(self)
+        self.patch(LayoutAnalyzer, 'analyze', analyzed)
+        self.patch(PageFeeder, 'close', closing)
+        list(AutoFinder(None, 'auto', {}, items()))
+        self.assertEqual(len(closed), 1)
+        self.assertEqual(seen['http://s/p1'], ['title0'])
+        self.assertEqual(seen['http://s/p0'], ['title4'])
+
+
+class ItemBufferTests(unittest.TestCase):
+    """Items come back out of the buffer as they went in"""
+
+    def testOrder(self):
+        from transmogrify.htmlcontentextractor.autofinder import ItemBuffer
+        unpicklable = dict(_path='x', func=lambda: None)
+        items = [dict(_path='p%d' % i, data='x' * i) for i in range(10)]
+        items.insert(5, unpicklable)
+        buffer = ItemBuffer(keep=3)
+        for item in items:
+            buffer.append(item)
+        self.assertEqual(len(buffer), 11)
+        self.assertEqual(buffer.spilled, 8)
+        out = list(buffer)
+        self.assertEqual(out, items)
+        self.assert_(out[5] is unpicklable)
+        self.assertEqual(len(buffer), 0)
+
+    def testUnpicklable(self):
+        from transmogrify.htmlcontentextractor.autofinder import ItemBuffer
+        class Broken(object):
+            def __getstate__(self):
+                raise AttributeError('no state')
+        deep = []
+        for i in range(100000):
+            deep = [deep]
+        items = [dict(_path='a'), dict(_path='b', broken=Broken()), dict(_path='c', deep=deep)]
+        buffer = ItemBuffer(keep=1)
+        for item in items:
+            buffer.append(item)
+        out = list(buffer)
+        self.assertTrue(out[1] is items[1])
+        self.assertTrue(out[2] is items[2])
+
+    def testKeepsItemsByDefault(self):
+        from transmogrify.htmlcontentextractor.autofinder import AutoFinder, ItemBuffer
+        items = list(PatternStoreTests('testReuse').items())
+        section = AutoFinder(None, 'auto', {}, iter(items))
+        self.assertEqual(section.buffer, 0)
+        out = list(section)
+        self.assertEqual(len(out), len(items))
+        self.assertTrue(all(a is b for (a, b) in zip(out, items)))
+        buffer = ItemBuffer()
+        for item in items:
+            buffer.append(item)
+        self.assertEqual(buffer.spilled, 0)
+
+    def testAutoFinder(self):
+        from transmogrify.htmlcontentextractor.autofinder import AutoFinder
+        items = PatternStoreTests('testReuse').items
+        expected = [sorted(item.items()) for item in AutoFinder(None, 'auto', {'buffer': '0'}, items())]
+        self.assertEqual([sorted(item.items()) for item in AutoFinder(None, 'auto', {'buffer': '2'}, items())],
+                         expected)
+
+
+class StreamTests(unittest.TestCase):
+    """Streamed links resolve against the path when items have no _site_url"""
+
+    def testNoSiteUrl(self):
+        from transmogrify.htmlcontentextractor.templatefinder import TemplateFinder
+        listing = ('<html><body><div><a href="item1">Item1</a></div>'
+                   '<div><a href="http://other.com/item2">Item2</a></div>'
+                   '<div><a href="mailto:item3">Item3</a></div></body></html>')
+        items = [dict(_path='listing', text=listing)] + \
+                [dict(_path=path, text='<html><body>%s</body></html>' % path)
+                 for path in ('item1', 'item2', 'item3')]
+        options = {'repeat': '//div', 'url': './a/@href', 'stream': 'True',
+                   'rules': 'title = ./a/text()'}
+        found = dict((item['_path'], item)
+                     for item in TemplateFinder(None, 'template', options, (i for i in items)))
+        self.assertEqual(sorted(found), ['item1', 'item2', 'item3', 'listing'])
+        self.assertEqual(found['item1']['title'], 'Item1')
+        self.assertFalse('title' in found['item2'])
+        self.assertFalse('title' in found['item3'])
+        self.assertFalse('_site_url' in found['item1'])
+
+    def extract(self, stream, **options):
+        from transmogrify.htmlcontentextractor.templatefinder import TemplateFinder
+        listing = '<html><body><div><a href="item1">Item1</a></div></body></html>'
+        items = [dict(_site_url='http://test.com/', _path='listing', text=listing),
+                 dict(_site_url='http://test.com/', _path='item1', text='body')]
+        options.update({'repeat': '//div', 'url': './a/@href', 'stream': stream,
+                        'rules': 'title = ./a/text()\n'
+                                 'label = tal python:item["title"] + ":" + item["text"]'})
+        section = TemplateFinder(None, 'template', options, (i for i in items))
+        return dict((item['_path'], item) for item in section)
+
+    def testTalSeesLinkedItem(self):
+        buffered = self.extract('False')['item1']
+        streamed = self.extract('True')['item1']
+        self.assertEqual(buffered['label'], 'Item1:body')
+        self.assertEqual(sorted(streamed.items()), sorted(buffered.items()))
+
+    def testSeenIsBounded(self):
+        import logging
+        from transmogrify.htmlcontentextractor.templatefinder import TemplateFinder
+        listing = '<html><body><div><a href="p0">P0</a></div></body></html>'
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger = logging.getLogger('template')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.INFO)
+        for (max_seen, pending) in (('10', 0), ('1', 1)):
+            items = [dict(_site_url='http://test.com/', _path='p%d' % i, text='<p>%d</p>' % i)
+                     for i in range(3)]
+            items.append(dict(_site_url='http://test.com/', _path='listing', text=listing))
+            options = {'repeat': '//div', 'url': './a/@href', 'stream': 'True',
+                       'max_seen': max_seen, 'rules': 'title = ./a/text()'}
+            del messages[:]
+            list(TemplateFinder(None, 'template', options, (i for i in items)))
+            # once forgotten p0 is taken for an item still to come
+            self.assertEqual(len([m for m in messages if 'never crawled' in m]), pending)
+
+
 def test_suite():
     suite = unittest.TestSuite((
             doctest.DocFileSuite(
@@ -118,6 +939,23 @@ def test_suite():
                 tearDown=tearDown,
                 optionflags=optionflags,
                 ),
+            unittest.makeSuite(RulePathTests),
+            unittest.makeSuite(NonOverlapTests),
+            unittest.makeSuite(SignatureTests),
+            unittest.makeSuite(ClusteringTests),
+            unittest.makeSuite(ClusterSeqTests),
+            unittest.makeSuite(TextBlockTests),
+            unittest.makeSuite(DiffScoreTests),
+            unittest.makeSuite(PatternStoreTests),
+            unittest.makeSuite(IdentifyLayoutTests),
+            unittest.makeSuite(TokenizerTests),
+            unittest.makeSuite(StyleSheetTests),
+            unittest.makeSuite(BenchmarkSuiteTests),
+            unittest.makeSuite(MetricsTests),
+            unittest.makeSuite(ProgressTests),
+            unittest.makeSuite(AnchorTests),
+            unittest.makeSuite(ItemBufferTests),
+            unittest.makeSuite(StreamTests),
             ))
     return suite
 
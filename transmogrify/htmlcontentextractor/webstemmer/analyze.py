@@ -26,15 +26,16 @@
 #  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
 
-import sys, re
+import sys, re, random, time
 from difflib import SequenceMatcher
+from bisect import bisect_right
 from htmlparser3 import HTMLParser3
 from textcrawler import HTMLLinkFinder, wash_url
 from htmldom import parse
 from zipdb import ACLDB, ZipLoader
 from urlparse import urljoin
-from layoutils import sigchars, get_textblocks, retrieve_blocks, WEBSTEMMER_VERSION, KEY_ATTRS
-from math import log
+from layoutils import sigchars, get_textblocks, retrieve_blocks, retrieve_block_ids, WEBSTEMMER_VERSION, KEY_ATTRS
+from math import log, ceil
 
 upperbound = min
 lowerbound = max
@@ -110,18 +111,52 @@ class LayoutSectionCluster:
     return '<SC-%d (diff=%s, weight_noanchor=%d): %r>' % \
            (self.id, self.diffscore, self.weight_noanchor, self.blockgroups[0][0].path)
 
-  def calc_diffscore(self):
-    (maxscore, score) = (0, 0)
+  # When error is given and there are more pairs than needed, the
+  # diffscore is estimated from a sample of pairs instead of diffing
+  # every pair. Pairs are drawn in proportion to their length so the
+  # estimate is within error of the exact score with the given confidence
+  # (Hoeffding). Smaller clusters are always scored exactly.
+  def calc_diffscore(self, error=0, confidence=0.95):
     block_texts = [ ''.join( b.sig_text for b in blocks ) for blocks in self.blockgroups ]
+    block_texts = [ text for text in block_texts if text ]
+    n = len(block_texts)
+    if error:
+      samples = diff_samples(error, confidence)
+      if samples < n*(n-1)//2:
+        self.diffscore = self.sample_diffscore(block_texts, samples)
+        return
+    (maxscore, score) = (0, 0)
     for (i,text0) in enumerate(block_texts):
-      if not text0: continue
       for text1 in block_texts[i+1:]: # 0 <= j < i
-        if not text1: continue
         maxscore += len(text0)+len(text1)
         score += diff_score(text0, text1)
     self.diffscore = score / float(lowerbound(maxscore, 1.0))
     return
 
+  def sample_diffscore(self, block_texts, samples):
+    # picking text i by its length and then any other text j draws
+    # the pair (i,j) in proportion to len(i)+len(j).
+    # seeded so the same pages always give the same layouts.
+    rnd = random.Random(self.id)
+    n = len(block_texts)
+    cumlens = []
+    total = 0
+    for text in block_texts:
+      total += len(text)
+      cumlens.append(total)
+    score = 0.0
+    for _ in xrange(samples):
+      i = bisect_right(cumlens, rnd.randrange(total))
+      j = rnd.randrange(n-1)
+      if i <= j: j += 1
+      (text0, text1) = (block_texts[i], block_texts[j])
+      score += diff_score(text0, text1) / float(len(text0)+len(text1))
+    return score / samples
+
+# number of sampled pairs for a diffscore within error with the given confidence.
+def diff_samples(error, confidence):
+  return int(ceil(log(2/(1-float(confidence))) / (2*error*error)))
+
 
 ##  find_clusters
 ##
@@ -131,9 +166,9 @@ def find_clusters(para_blocks):
     r = []
     prev = None
     for b in blocks:
-      if prev == None or b.path != prev:
-        r.append(b.path)
-      prev = b.path
+      if prev == None or b.pathid != prev:
+        r.append(b.pathid)
+      prev = b.pathid
     return r
 
   def find_common(seqs):
@@ -151,7 +186,7 @@ def find_clusters(para_blocks):
   # clusters = [ ( doc1_blocks1, doc2_blocks1, ..., docm_blocks1 ),
   #                ...
   #              ( doc1_blocksn, doc2_blocksn, ..., docm_blocksn ) ]
-  clusters = zip(*[ retrieve_blocks(common_paths, blocks) for blocks in para_blocks ])
+  clusters = zip(*[ retrieve_block_ids(common_paths, blocks) for blocks in para_blocks ])
 
   # compare each cluster of text blocks.
   layout = []
@@ -162,6 +197,19 @@ def find_clusters(para_blocks):
   return layout
 
 
+##  sim_upperbound
+##
+##  find_clusters only puts a block in a layout if its path is one both
+##  pages have, so the blocks under those paths bound the similarity
+##  LayoutAnalyzer.analyze works out for a pair of pages from above.
+##
+def sim_upperbound(page1, page2):
+  (w1, w2) = (page1.path_weight, page2.path_weight)
+  if len(w2) < len(w1): (w1, w2) = (w2, w1)
+  common = sum( w + w2[path] for (path,w) in w1.iteritems() if path in w2 )
+  return common / lowerbound(float(page1.weight + page2.weight), 1)
+
+
 ##  LayoutCluster
 ##
 class LayoutCluster:
@@ -172,6 +220,7 @@ class LayoutCluster:
     self.pages = []
     self.score = 0
     self.pattern = None
+    self.pathids = None
     self.title_sectno = -1
     return
 
@@ -182,18 +231,19 @@ class LayoutCluster:
     self.pages.append(page)
     return
 
-  def fixate(self, title_threshold):
+  def fixate(self, title_threshold, diff_error=0, diff_confidence=0.95):
     if len(self.pages) < 2: return
     layout = find_clusters([ p.blocks for p in self.pages ])
     if not layout: return
     # obtain the diffscores of this layout.
     for sect in layout:
-      sect.calc_diffscore()
+      sect.calc_diffscore(diff_error, diff_confidence)
     # why log?
     self.score = log(len(self.pages)) * sum( sect.diffscore * sect.weight_avg for sect in layout )
     # discover main sections.
     self.pattern = [ (sect.diffscore, sect.diffscore*sect.weight_avg,
                       sect.blockgroups[0][0].path) for sect in layout ]
+    self.pathids = [ sect.blockgroups[0][0].pathid for sect in layout ]
     largest = gmax(layout, key=lambda sect: sect.diffscore*sect.weight_avg)
     if self.debug:
       for sect in layout:
@@ -259,16 +309,113 @@ class LayoutCluster:
     return
 
 
+##  Progress
+##
+##  Reports how a long task is going at most once every interval
+##  seconds: units done, their rate, comparisons per second and the
+##  time left when the total is known. Lines go to write, stderr by
+##  default. Messages (the debug output) are always written.
+##
+class Progress:
+
+  def __init__(self, write=None, interval=5.0):
+    self.write = write
+    self.interval = interval
+    self.start('Loading')
+    return
+
+  def start(self, task, total=None, unit='pages'):
+    self.task = task
+    self.total = total
+    self.unit = unit
+    self.done = 0
+    self.comparisons = 0
+    self.started = time.time()
+    self.next_report = self.started + self.interval
+    return
+
+  def step(self, n=1):
+    self.done += n
+    if self.next_report <= time.time():
+      self.report()
+    return
+
+  def compared(self, n=1):
+    self.comparisons += n
+    if self.next_report <= time.time():
+      self.report()
+    return
+
+  def report(self, final=False):
+    now = time.time()
+    self.next_report = now + self.interval
+    taken = lowerbound(now - self.started, 1e-6)
+    if self.total is None:
+      line = '%s: %d %s' % (self.task, self.done, self.unit)
+    else:
+      line = '%s: %d/%d %s' % (self.task, self.done, self.total, self.unit)
+    if final:
+      line += ' in %.1fs' % taken
+    line += ', %.1f %s/s' % (self.done / taken, self.unit)
+    if self.comparisons:
+      line += ', %.1f comparisons/s' % (self.comparisons / taken)
+    if not final and self.total is not None and self.done:
+      left = int((self.total - self.done) * taken / self.done)
+      line += ', eta %dm%02ds' % (left // 60, left % 60)
+    self.message(line)
+    return
+
+  def finish(self):
+    self.report(final=True)
+    return
+
+  def message(self, msg):
+    if self.write is None:
+      stderr.write(msg+'\n'); stderr.flush()
+    else:
+      self.write(msg)
+    return
+
+# reports nothing.
+class NullProgress(Progress):
+
+  def __init__(self):
+    Progress.__init__(self, interval=None)
+    return
+
+  def start(self, task, total=None, unit='pages'):
+    return
+  def step(self, n=1):
+    return
+  def compared(self, n=1):
+    return
+  def finish(self):
+    return
+  def message(self, msg):
+    return
+
+NULL_PROGRESS = NullProgress()
+
+
 ##  LayoutAnalyzer
 ##
 class HTMLPage:
 
-  def __init__(self, name, tree, encoder=None):
+  def __init__(self, name, tree, encoder=None, keep_text=True):
     self.name = name
     self.blocks = get_textblocks(tree, encoder)
+    if not keep_text:
+      for b in self.blocks:
+        b.discard_text()
     self.weight = sum( b.weight for b in self.blocks )
+    # total weight of the blocks under each path id.
+    self.path_weight = {}
+    for b in self.blocks:
+      self.path_weight[b.pathid] = self.path_weight.get(b.pathid, 0) + b.weight
     #self.weight_noanchor = sum( b.weight_noanchor for b in self.blocks )
     self.anchor_strs = []
+    # the same strings as a set, to add each only once
+    self.anchor_set = set()
     return
 
   def __repr__(self):
@@ -278,14 +425,34 @@ class HTMLPage:
     for s in anchor_strs:
       s = sigchars(s)
       if s:
+        self.anchor_set.add(s)
         self.anchor_strs.append(s)
     return
 
 class LayoutAnalyzer:
 
-  def __init__(self, debug=0):
+  # prune: skip comparing pages whose sim_upperbound is already below
+  #   the threshold. This doesn't change the clusters found.
+  # keep_text: keep the original text of each block as well as sig_text.
+  #   Clustering doesn't need it.
+  # diff_error, diff_confidence: estimate the diffscores of large clusters
+  #   from sampled page pairs (see LayoutSectionCluster.calc_diffscore).
+  #   diff_error=0, the default, always compares every pair.
+  # comparisons, pruned: the page pairs analyze has compared and the ones
+  #   it skipped by pruning.
+  # progress: the Progress that loading and analyze report to. Throttled
+  #   lines on stderr by default, NullProgress() for none.
+  def __init__(self, debug=0, prune=True, keep_text=True,
+               diff_error=0, diff_confidence=0.95, progress=None):
     self.pages = {}
+    self.progress = progress or Progress()
+    self.comparisons = 0
+    self.pruned = 0
     self.debug = debug
+    self.prune = prune
+    self.keep_text = keep_text
+    self.diff_error = diff_error
+    self.diff_confidence = diff_confidence
     self.encoder = None
     return
 
@@ -298,60 +465,73 @@ class LayoutAnalyzer:
     return
 
   def add_tree(self, name, tree):
-    page = HTMLPage(name, tree, encoder=self.encoder)
+    page = HTMLPage(name, tree, encoder=self.encoder, keep_text=self.keep_text)
     self.pages[name] = page
     return len(self.pages)
 
+  # duplicates don't change a title's score so they're only kept once.
   def add_anchor_strs(self, name, anchor_strs):
     if name in self.pages:
       p = self.pages[name]
       for s in anchor_strs:
         s = sigchars(s)
-        if s:
+        if s and s not in p.anchor_set:
+          p.anchor_set.add(s)
           p.anchor_strs.append(s)
     return
 
+  # verbose=False reports nothing unless debugging.
   def analyze(self, cluster_threshold=0.97, title_threshold=0.6, verbose=True):
-    print >>stderr, 'Clustering %d files with threshold=%f...' % (len(self.pages), cluster_threshold)
+    if verbose or self.debug:
+      progress = self.progress
+    else:
+      progress = NULL_PROGRESS
+    progress.message('Clustering %d files with threshold=%f...' % (len(self.pages), cluster_threshold))
+    progress.start('Clustering', len(self.pages))
     clusters = []
     keys = self.pages.keys()
 
     for (urlno,url1) in enumerate(keys):
       page1 = self.pages[url1]
       if self.debug:
-        print >>stderr, ' %d: %r' % (urlno, page1)
-      elif verbose:
-        stderr.write(' %d: ' % urlno)
+        progress.message(' %d: %r' % (urlno, page1))
       # search from the smallest cluster (not sure if this helps actually...)
       clusters.sort(key=lambda c: len(c.pages))
       for c0 in clusters:
         for page2 in c0.pages:
+          if self.prune and sim_upperbound(page1, page2) < cluster_threshold:
+            self.pruned += 1
+            if self.debug:
+              progress.message('    pruned: %r' % page2)
+            break
+          self.comparisons += 1
           layout = find_clusters([ page1.blocks, page2.blocks ])
           total_weight = sum( c.weight for c in layout )
           sim = total_weight / lowerbound(float(page1.weight + page2.weight), 1)
           if self.debug:
-            print >>stderr, '    sim=%.3f (%d): %r' % (sim, total_weight, page2)
-          elif verbose:
-            stderr.write('.'); stderr.flush()
+            progress.message('    sim=%.3f (%d): %r' % (sim, total_weight, page2))
+          progress.compared()
           if sim < cluster_threshold: break
         else:
-          if verbose:
-            print >>stderr, 'joined: %r' % c0
+          if self.debug:
+            progress.message('joined: %r' % c0)
           c0.add(page1)
           break
       else:
         c0 = LayoutCluster(url1, debug=self.debug)
         c0.add(page1)
-        if verbose:
-          print >>stderr, 'formed: %r' % c0
+        if self.debug:
+          progress.message('formed: %r' % c0)
         clusters.append(c0)
+      progress.step()
+    progress.finish()
 
-    stderr.write('Fixating')
+    progress.start('Fixating', len(clusters), 'clusters')
     for c in clusters:
-      c.fixate(title_threshold)
-      stderr.write('.'); stderr.flush()
+      c.fixate(title_threshold, self.diff_error, self.diff_confidence)
+      progress.step()
+    progress.finish()
     clusters.sort(key=lambda c: c.score, reverse=True)
-    print >>stderr
     return clusters
 
 
@@ -368,6 +548,8 @@ class PageFeeder:
     self.linkinfo = linkinfo
     self.dic = {}
     self.baseid = None
+    self.progress = analyzer.progress
+    self.progress.start('Loading')
     return
 
   # dirtie
@@ -376,14 +558,22 @@ class PageFeeder:
   def inject_url(self, url):
     return True
   def add(self, name, s):
-    name = self.baseid+name
-    if name not in self.dic: self.dic[name] = []
-    self.dic[name].append(s)
+    self.add_anchor(self.baseid+name, s)
+    return
+
+  # s is the text of a link to the page name. it goes to the analyzer
+  # straight away if the page has been added, otherwise when it is.
+  def add_anchor(self, name, s):
+    if name in self.analyzer.pages:
+      self.analyzer.add_anchor_strs(name, [s])
+    else:
+      if name not in self.dic: self.dic[name] = []
+      self.dic[name].append(s)
     return
 
   def feed_page(self, name, data):
     if name == self.linkinfo:
-      print >>stderr, 'Loading: %r' % name
+      self.progress.message('Loading: %r' % name)
       for line in data.split('\n'):
         if line:
           (name,strs) = eval(line)
@@ -401,16 +591,29 @@ class PageFeeder:
         parser.feed_byte(data)
         parser.close()
       if not self.acldb or self.acldb.allowed(name):
-        tree = parse(data, charset=self.default_charset, base_href=base_href)
-        n = self.analyzer.add_tree(name, tree)
-        print >>stderr, 'Added: %d: %s' % (n, name)
-      else:
-        print >>stderr, 'Skipped: %s' % name
+        tree = parse(data, charset=self.default_charset, base_href=base_href, styles=False)
+        self.feed_tree(name, tree)
+      elif self.debug:
+        self.progress.message('Skipped: %s' % name)
+    return
+
+  # feed a page that's already parsed, with htmldom or lxml.html.
+  def feed_tree(self, name, tree):
+    if not self.acldb or self.acldb.allowed(name):
+      n = self.analyzer.add_tree(name, tree)
+      if name in self.dic:
+        self.analyzer.add_anchor_strs(name, self.dic.pop(name))
+      if self.debug:
+        self.progress.message('Added: %d: %s' % (n, name))
+      self.progress.step()
+    elif self.debug:
+      self.progress.message('Skipped: %s' % name)
     return
 
+  # only the linkinfo of pages added before it was loaded is left to do.
   def close(self):
-    for (name, strs) in self.dic.iteritems():
-      self.analyzer.add_anchor_strs(name, strs)
+    for name in [ name for name in self.dic if name in self.analyzer.pages ]:
+      self.analyzer.add_anchor_strs(name, self.dic.pop(name))
     return
 
 
@@ -418,21 +621,23 @@ class PageFeeder:
 def main():
   import getopt
   def usage():
-    print '''usage: analyze.py [-d] [-t cluster_threshold] [-T title_threshold] [-S score_threshold] [-L linkinfo] [-c default_charset] [-a accept_pat] [-j reject_pat] [-P mangle_pat] files ...'''
+    print '''usage: analyze.py [-d] [-t cluster_threshold] [-T title_threshold] [-S score_threshold] [-e diff_error] [-L linkinfo] [-c default_charset] [-a accept_pat] [-j reject_pat] [-P mangle_pat] files ...'''
     sys.exit(2)
   try:
-    (opts, args) = getopt.getopt(sys.argv[1:], 'dt:T:S:L:c:a:j:P:')
+    (opts, args) = getopt.getopt(sys.argv[1:], 'dt:T:S:e:L:c:a:j:P:')
   except getopt.GetoptError:
     usage()
   (debug, cluster_threshold, title_threshold, score_threshold, default_charset) = (0, 0.97, 0.6, 100, 'utf-8')
   acldb = None
   mangle_pat = None
   linkinfo = 'linkinfo'
+  diff_error = 0
   for (k, v) in opts:
     if k == '-d': debug += 1
     elif k == '-t': cluster_threshold = float(v)
     elif k == '-T': title_threshold = float(v)
     elif k == '-S': score_threshold = float(v)
+    elif k == '-e': diff_error = float(v)
     elif k == '-L': linkinfo = ''
     elif k == '-c': default_charset = v
     elif k == '-a':
@@ -446,7 +651,7 @@ def main():
   if not args:
     usage()
   #
-  analyzer = LayoutAnalyzer(debug=debug)
+  analyzer = LayoutAnalyzer(debug=debug, diff_error=diff_error)
   if mangle_pat:
     analyzer.set_encoder(mangle_pat)
   print '### version=%s' % WEBSTEMMER_VERSION
@@ -464,7 +669,7 @@ def main():
       for line in fp:
         name = line.strip()
         if debug:
-          print >>stderr, 'Loading: %r' % name
+          analyzer.progress.message('Loading: %r' % name)
         fp2 = file(name)
         data = fp2.read()
         fp2.close()
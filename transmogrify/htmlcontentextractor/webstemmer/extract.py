@@ -29,9 +29,10 @@
 # todo: read special hooks from patfile
 
 import sys, re
+from ast import literal_eval
 from htmldom import parse
 from zipdb import ACLDB, ZipLoader
-from layoutils import sigchars, get_textblocks, retrieve_blocks, WEBSTEMMER_VERSION, KEY_ATTRS
+from layoutils import sigchars, get_textblocks, retrieve_blocks, retrieve_block_ids, intern_path, WEBSTEMMER_VERSION, KEY_ATTRS
 
 stderr = sys.stderr
 
@@ -42,12 +43,13 @@ stderr = sys.stderr
 
 class LayoutSection:
 
-  def __init__(self, id, diffscore, mainscore, blocks):
+  def __init__(self, id, diffscore, mainscore, blocks, path=None):
     self.id = id
     self.diffscore = diffscore
     self.mainscore = mainscore
     self.weight = sum( b.weight for b in blocks )
     self.blocks = blocks
+    self.path = path
     return
 
 
@@ -61,17 +63,18 @@ class LayoutPattern:
     self.title_sectno = title_sectno
     self.main_sectno = main_sectno
     self.pattern = pattern
+    self.pathids = [ intern_path(p) for (d,m,p) in pattern ]
     return
 
   def match_blocks(self, blocks0, strict=True):
     diffs = [ d for (d,m,p) in self.pattern ]
     mains = [ m for (d,m,p) in self.pattern ]
-    paths = [ p for (d,m,p) in self.pattern ]
     layout = []
-    for (diffscore,mainscore,blocks1) in zip(diffs, mains, retrieve_blocks(paths, blocks0)):
+    paths = [ p for (d,m,p) in self.pattern ]
+    for (diffscore,mainscore,blocks1,path) in zip(diffs, mains, retrieve_block_ids(self.pathids, blocks0), paths):
       if strict and not blocks1:
         return None
-      layout.append(LayoutSection(len(layout), diffscore, mainscore, blocks1))
+      layout.append(LayoutSection(len(layout), diffscore, mainscore, blocks1, path))
     return layout
 
 
@@ -83,9 +86,12 @@ class LayoutPatternSet:
     self.pats = []
     self.debug = debug
     self.encoder = None
+    self.mangle_pat = None
+    self.index = None
     return
 
   def set_encoder(self, mangle_pat):
+    self.mangle_pat = mangle_pat
     pat = re.compile(mangle_pat)
     def encode_element2(e):
       return e.tag + ''.join(sorted( ':%s=%s' % (k.lower(), ''.join(pat.findall(e.attrs[k].lower())))
@@ -93,14 +99,16 @@ class LayoutPatternSet:
     self.encoder = encode_element2
     return
 
+  # patterns are python literals so they're read with literal_eval,
+  # a pattern file can't run code.
   def read(self, fp):
     for line in fp:
       line = line.strip()
       if not line or line.startswith('#'): continue
       if line.startswith('!mangle_pat='):
-        self.set_encoder(eval(line[line.index('=')+1:]))
+        self.set_encoder(literal_eval(line[line.index('=')+1:]))
         continue
-      x = eval(line)
+      x = literal_eval(line)
       if len(x) == 5:
         (score, name, title_sectno, main_sectno, pattern) = x
       else:
@@ -109,19 +117,57 @@ class LayoutPatternSet:
       self.pats.append(LayoutPattern(name, score, title_sectno, main_sectno, pattern))
     return
 
+  # index: pathid -> [ patno, ... ] of the patterns with sections on that path.
+  # rebuilt whenever pats is changed.
+  def get_index(self):
+    if self.index is None or self.index[0] is not self.pats or self.index[1] != len(self.pats):
+      pathids = []
+      index = {}
+      for (patno,pat1) in enumerate(self.pats):
+        ids = set( intern_path(p) for (d,m,p) in pat1.pattern )
+        pathids.append(len(ids))
+        for i in ids:
+          index.setdefault(i, []).append(patno)
+      self.index = (self.pats, len(self.pats), pathids, index)
+    return self.index
+
+  # A pattern can only take blocks on its own paths, so the weight of
+  # those blocks bounds the weight of its layout. Patterns are tried from
+  # the highest bound and we stop once no bound beats the best layout.
+  # With strict only patterns with every path on the page are tried.
+  # Gives the same layout as trying every pattern in turn.
   def identify_layout(self, tree, pat_threshold, strict=True):
     top = (None, None)
     blocks = get_textblocks(tree, encoder=self.encoder)
     if 2 <= self.debug:
       tree.dump()
     max_weight = sum( b.weight for b in blocks ) * pat_threshold
-    for pat1 in self.pats:
+    (_, _, pathids, index) = self.get_index()
+    path_weight = {}
+    for b in blocks:
+      path_weight[b.pathid] = path_weight.get(b.pathid, 0) + b.weight
+    bounds = {}
+    found = {}
+    for (i,weight) in path_weight.iteritems():
+      for patno in index.get(i, ()):
+        bounds[patno] = bounds.get(patno, 0) + weight
+        found[patno] = found.get(patno, 0) + 1
+    candidates = sorted( (-bound, patno) for (patno,bound) in bounds.iteritems()
+                         if not strict or found[patno] == pathids[patno] )
+    top_patno = None
+    for (bound,patno) in candidates:
+      bound = -bound
+      if bound < max_weight or (bound == max_weight and (top_patno is None or top_patno < patno)):
+        break
+      pat1 = self.pats[patno]
       layout = pat1.match_blocks(blocks, strict=strict)
       if layout:
         weight = sum( sect.weight for sect in layout )
-        if max_weight < weight:
+        # on a tie the earlier pattern wins, as it would trying them in order.
+        if max_weight < weight or (weight == max_weight and top_patno is not None and patno < top_patno):
           top = (pat1, layout)
           max_weight = weight
+          top_patno = patno
     return top
 
   def dump_text(self, name, tree,
@@ -182,7 +228,7 @@ class TextExtractor:
 
   def feed_page(self, name, fp):
     if name == self.linkinfo: return
-    self.feed_tree(name, parse(fp, charset=self.default_charset))
+    self.feed_tree(name, parse(fp, charset=self.default_charset, styles=False))
     return
 
 
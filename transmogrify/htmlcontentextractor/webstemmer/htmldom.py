@@ -38,7 +38,7 @@ debug = 0
 
 ##  HTMLElement
 ##
-class HTMLElement:
+class HTMLElement(object):
   """
   This class represents an HTML element.
   This object has the following public attributes.
@@ -50,21 +50,26 @@ class HTMLElement:
   attrs: dictionary which contains attributes.
   active: boolean flag which indicates whether this element is
           still under construction.
+  form: the HTMLForm of a form field.
   """
+
+  # a page has a lot of elements so don't give each a __dict__.
+  __slots__ = ('root', 'tag', 'parent', 'active', 'attrs', 'children', 'form')
   
   def __init__(self, root, tag, children=None, attrs=None, parent=None, active=True):
     """Creates an instance of the HTMLElement class.
+    The element takes over children and attrs rather than copying them.
     """
     self.root = root
     self.tag = str(tag)  # not unicode object!
     self.parent = parent
     self.active = active
     if attrs:
-      self.attrs = attrs.copy()
+      self.attrs = attrs
     else:
       self.attrs = {}
     if children != None:
-      self.children = children[:]
+      self.children = children
       for c in children:
         if isinstance(c, HTMLElement):
           c.parent = self
@@ -89,7 +94,10 @@ class HTMLElement:
     return tuple( self.attrs.get(k) for k in keys )
 
   def dup(self):
-    return HTMLElement(self.root, self.tag, self.children, self.attrs,
+    children = self.children
+    if children != None:
+      children = children[:]
+    return HTMLElement(self.root, self.tag, children, self.attrs.copy(),
                        self.parent, self.active)
 
   def finish(self):
@@ -310,10 +318,16 @@ class HTMLRootElement(HTMLElement):
 ##
 class HTMLDocumentBuilder(HTMLHandler):
   
-  def __init__(self, base_href=None, stylesheet=None):
+  # styles=False ignores any stylesheet given, so none is imported or
+  #   parsed and elements get no _style or _contexts. It's the same as
+  #   passing no stylesheet, which is how the page feeders already parsed,
+  #   so it only saves time for callers that would pass one.
+  def __init__(self, base_href=None, stylesheet=None, styles=True):
     self.root = HTMLRootElement(base_href=base_href)
     self.curform = None
     self.curstack = [self.root]
+    if not styles:
+      stylesheet = None
     self.stylesheet = stylesheet
     return
 
@@ -340,7 +354,8 @@ class HTMLDocumentBuilder(HTMLHandler):
       self.root.add_header(e)
     else:
       self.curstack[-1].add_child(e)
-      e.set_style(self.stylesheet)
+      if self.stylesheet:
+        e.set_style(self.stylesheet)
     return
 
   def start_unknown(self, tag, attrs):
@@ -360,7 +375,8 @@ class HTMLDocumentBuilder(HTMLHandler):
         self.root.add_header(e)
       else:
         self.curstack[-1].add_child(e)
-        e.set_style(self.stylesheet)
+        if self.stylesheet:
+          e.set_style(self.stylesheet)
       self.curstack.append(e)
       if self.curform and tag in FORM_FIELD_TAGS:
         self.curform.add_field(e)
@@ -393,8 +409,8 @@ class HTMLDocumentBuilder(HTMLHandler):
 
 ##  Utilities
 ##
-def parse(x, base_href=None, charset=None, stylesheet=None):
-  builder = HTMLDocumentBuilder(base_href=base_href, stylesheet=stylesheet)
+def parse(x, base_href=None, charset=None, stylesheet=None, styles=True):
+  builder = HTMLDocumentBuilder(base_href=base_href, stylesheet=stylesheet, styles=styles)
   parser = HTMLParser3(builder, charset=charset)
   if isinstance(x, unicode):
     parser.feed_unicode(x)
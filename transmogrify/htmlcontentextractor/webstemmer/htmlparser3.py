@@ -104,8 +104,8 @@ class HTMLParser3(SGMLParser3):
     'dd':('dl',)
     }
 
-  def __init__(self, handler, charset=None, debug=0):
-    SGMLParser3.__init__(self)
+  def __init__(self, handler, charset=None, debug=0, fast=True):
+    SGMLParser3.__init__(self, fast=fast)
     self.debug = debug
     self.handler = handler
     self.linepos = 0
@@ -27,8 +27,12 @@
 #
 
 import sys, re
-from htmldom import tag
-from htmlutils import concat
+from htmldom import tag, HTMLElement
+from htmlutils import concat, BLOCK_TAGS
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 WEBSTEMMER_VERSION='0.6.1'
 
@@ -41,15 +45,34 @@ SIG_CHARS = re.compile(r'\w+', re.UNICODE)
 def sigchars(s):
   return ''.join(SIG_CHARS.findall(s)).lower()
 
+##  Path interning
+##
+##  Each distinct encoded path gets a small int id so blocks are compared
+##  as ints, and pages share one copy of each path string.
+##
+PATH_IDS = {}
+PATHS = []
+def intern_path(path):
+  try:
+    return PATH_IDS[path]
+  except KeyError:
+    pathid = PATH_IDS[path] = len(PATHS)
+    PATHS.append(path)
+    return pathid
+
 KEY_ATTRS = dict.fromkeys('id class align valign rowspan colspan'.split(' '))
 def encode_element(e):
   return e.tag + ''.join(sorted( ':%s=%s' % (k.lower(), e.attrs[k].lower())
                                  for k in e.attrs.keys() if k in KEY_ATTRS ))
 
-class TextBlock:
+class TextBlock(object):
+
+  # every page's blocks are kept while clustering so don't give each a __dict__.
+  __slots__ = ('pathid', 'path', 'orig_text', 'sig_text', 'weight', 'weight_noanchor')
   
   def __init__(self, path, text, text_noanchor):
-    self.path = path
+    self.pathid = intern_path(path)
+    self.path = PATHS[self.pathid]
     self.orig_text = text
     self.sig_text = sigchars(text)
     self.weight = len(self.sig_text)
@@ -57,7 +80,13 @@ class TextBlock:
     return
   
   def __repr__(self):
-    return '<Text: %s %r>' % (self.path, self.orig_text[:10])
+    return '<Text: %s %r>' % (self.path, (self.orig_text or self.sig_text)[:10])
+
+  # clustering only uses sig_text so orig_text can go once a page is
+  # reduced to blocks.
+  def discard_text(self):
+    self.orig_text = None
+    return
 
 
 ##  Chunker
@@ -135,8 +164,99 @@ class Chunker:
         r.append(b)
     return r
 
+##  LxmlChunker
+##
+##  Chunker for an lxml.html tree. Gives the same blocks as Chunker does
+##  for the htmldom tree of the page, so one lxml parse can be used to
+##  both find the layout and extract from it.
+##
+##  libxml2 leaves a p open around a block tag when an inline element
+##  is open inside the p, as in <p><a name=x><h3>. htmlparser3 ends the
+##  p (and everything in it) first, so the same is done here: open holds
+##  [tag, path, anchor, ended] for the elements being chunked and a
+##  block tag ends the innermost p that isn't outside another block.
+##
+class ElementAttrs(object):
+  # the parts of an element an encoder uses.
+  __slots__ = ('tag', 'attrs')
+  def __init__(self, e):
+    self.tag = e.tag
+    self.attrs = dict(e.attrib)
+    return
+
+class LxmlChunker(Chunker):
+
+  def __init__(self, encoder):
+    Chunker.__init__(self, encoder)
+    self.open = []
+    self.path = []
+    self.anchor = False
+    return
+
+  def chunk(self, e, path, anchor):
+    (self.path, self.anchor) = (path, anchor)
+    self.chunk_element(e)
+    return
+
+  # as HTMLParser3.end_previous(('p',), BLOCK_TAGS).
+  def end_p(self):
+    for i in xrange(len(self.open)-1, -1, -1):
+      frame = self.open[i]
+      if frame[0] == 'p':
+        self.chop(self.path)
+        (self.path, self.anchor) = (frame[1], frame[2])
+        for f in self.open[i:]:
+          f[3] = True
+        del self.open[i:]
+        break
+      elif frame[0] in BLOCK_TAGS:
+        break
+    return
+
+  def chunk_element(self, e):
+    t = e.tag
+    # comments and processing instructions
+    if not isinstance(t, basestring):
+      return
+    if t in BLOCK_TAGS or t == 'hr':
+      self.end_p()
+    if (t == 'img') and (e.get('alt') is not None):
+      s = e.get('alt')
+      # kludge to capture DropCaps. see Chunker.
+      if len(s) == 1 and not self.texts:
+        self.add(s, self.anchor)
+    elif t in self.IGNORE_TAGS:
+      pass
+    elif t in self.CHOP_TAGS:
+      self.chop(self.path)
+    elif e.text or len(e):
+      frame = [t, self.path, self.anchor, False]
+      self.open.append(frame)
+      if t == 'a':
+        self.anchor = True
+      if t in self.SIG_TAGS:
+        self.chop(self.path)
+        self.path = self.path + [self.encoder(ElementAttrs(e)).encode('ascii','replace')]
+      if e.text:
+        self.add(e.text, self.anchor)
+      for c in e:
+        self.chunk_element(c)
+        # text after a child belongs to this element, or to whatever
+        # is open if the element was ended early.
+        if c.tail:
+          self.add(c.tail, self.anchor)
+      if not frame[3]:
+        if t in self.SIG_TAGS:
+          self.chop(self.path)
+        self.open.pop()
+        (self.path, self.anchor) = (frame[1], frame[2])
+    return
+
 def get_textblocks(e, encoder=None):
-  return Chunker(encoder=(encoder or encode_element)).getblocks(e)
+  if isinstance(e, HTMLElement):
+    return Chunker(encoder=(encoder or encode_element)).getblocks(e)
+  # an lxml element, start from the top like htmldom.
+  return LxmlChunker(encoder=(encoder or encode_element)).getblocks(e.getroottree().getroot())
 
 
 ##  cluster
@@ -193,8 +313,72 @@ def cluster_seq(s1, s2, eq):
   return cluster
 #print cluster_seq('abcbcbcbcb', 'abcbbcbbd', lambda x:x, lambda x,y:x==y)
 
+##  cluster_seq_keys
+##
+##  Same as cluster_seq(s1, s2, lambda x,y: key(x) == key(y)) where keys1
+##  and keys2 are the keys of s1 and s2, using numpy. Keys are numbered so
+##  the equality table is one array comparison. Each cell only depends on
+##  the cells above, to the left and diagonally up-left, so a whole
+##  anti-diagonal of the table is filled in at once.
+##
+def cluster_seq_keys(keys1, keys2, s2):
+  if not keys1 or not keys2: return []
+  ids = {}
+  ids1 = numpy.array([ ids.setdefault(k, len(ids)) for k in keys1 ])
+  ids2 = numpy.array([ ids.setdefault(k, len(ids)) for k in keys2 ])
+  eq = (ids1[:,None] == ids2[None,:]).astype(numpy.int32)
+  (n1, n2) = eq.shape
+  # (a,b,c) as in cluster_seq.
+  ma = numpy.zeros((n1,n2), numpy.int32)
+  mb = numpy.zeros((n1,n2), numpy.int32)
+  mc = numpy.zeros((n1,n2), numpy.int32)
+  (ma[0,0], mb[0,0], mc[0,0]) = (0, eq[0,0], 3)
+  for d in xrange(1, n1+n2-1):
+    p1 = numpy.arange(max(0, d-n2+1), min(d, n1-1)+1)
+    p2 = d-p1
+    (u1, l2) = (numpy.maximum(p1-1, 0), numpy.maximum(p2-1, 0))
+    e = eq[p1,p2]
+    # candidates as (total, a, b, c). invalid ones get total -1.
+    a = ma[u1,l2] + mb[u1,l2]
+    best = [ numpy.where((0 < p1) & (0 < p2), a+e, -1), a, e, 3 ]
+    a = ma[p1,l2]
+    b = mb[p1,l2] + e
+    across = [ numpy.where(0 < p2, a+b, -1), a, b, 2 ]
+    a = ma[u1,p2] + mb[u1,p2]
+    down = [ numpy.where(0 < p1, a, -1), a, 0, 1 ]
+    for cand in (across, down):
+      # same order as sorting the tuples and taking the last.
+      better = cand[0] > best[0]
+      same = cand[0] == best[0]
+      for i in (1, 2, 3):
+        better |= same & (cand[i] > best[i])
+        same &= (cand[i] == best[i])
+      best = [ numpy.where(better, x, y) for (x,y) in zip(cand, best) ]
+    (ma[p1,p2], mb[p1,p2], mc[p1,p2]) = best[1:]
+  # now we traverse the table in reverse order.
+  (p1, p2) = (n1-1, n2-1)
+  cluster = [ [] for x in keys1 ]
+  while 1:
+    c = mc[p1,p2]
+    if c & 2:
+      if eq[p1,p2]:
+        cluster[p1].insert(0, s2[p2])
+      if not p2: break
+      p2 -= 1
+    if c & 1 and 0 < p1: p1 -= 1
+  return cluster
+
+# below this many cells the python version is quicker.
+NUMPY_MIN_CELLS = 10000
+
 def retrieve_blocks(pathseq, blocks):
-  return cluster_seq(pathseq, blocks, lambda p,b: p == b.path)
+  return retrieve_block_ids([ intern_path(p) for p in pathseq ], blocks)
+
+# same as retrieve_blocks but with the ids of the paths.
+def retrieve_block_ids(idseq, blocks):
+  if numpy is not None and NUMPY_MIN_CELLS <= len(idseq)*len(blocks):
+    return cluster_seq_keys(idseq, [ b.pathid for b in blocks ], blocks)
+  return cluster_seq(idseq, blocks, lambda i,b: i == b.pathid)
 
 
 # testing
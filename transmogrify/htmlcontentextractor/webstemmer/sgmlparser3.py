@@ -45,6 +45,17 @@ NOT_ENTITY_NAME = re.compile(r'[^a-zA-Z0-9#]')
 ENTITY_NAME_MAXCHARS = 20
 TAGNAME_SOMETHING = re.compile(r'[^\s]')
 
+# Fast path: complete, well-formed constructs within one chunk.
+# Anything these don't match goes through the state machine.
+FAST_NAME = r'[a-zA-Z][-a-zA-Z0-9_:.]*'
+FAST_ATTR = (r'(' + FAST_NAME + r')(?:\s*=\s*(?:"([^"&]*)"|\'([^\'&]*)\'|'
+             r'([^\s<>&"\'=`]+)(?![^\s>])))?')
+FAST_TAG = re.compile(r'<(/?)(' + FAST_NAME + r')((?:\s+' + FAST_ATTR + r')*)\s*/?>')
+FAST_ATTRS = re.compile(FAST_ATTR)
+FAST_COMMENT = re.compile(r'<!--([^->][^-]*)-->')
+FAST_DECL = re.compile(r'<!([^->][^>]*)>')
+FAST_ENTITY = re.compile(r'&([a-zA-Z0-9#]*)(?:;|(?=[^a-zA-Z0-9#]))')
+
 
 ##  SGMLParser3
 ##
@@ -54,7 +65,12 @@ class SGMLParser3:
   Mainly for instantiating HTMLParser3.
   """
 
-  def __init__(self):
+  # fast: scan text and well-formed tags, entities, comments and
+  #   declarations with regexps, using the state machine only for
+  #   the rest. The handlers are called exactly the same.
+  def __init__(self, fast=True):
+    if fast:
+      self.parse_pcdata = self.parse_pcdata_fast
     # parse1: current state:
     #   parse_pcdata, parse_cdata, parse_cdata_end, 
     #   parse_entity_0, parse_entity_1,
@@ -149,6 +165,70 @@ class SGMLParser3:
     self.charpos = i1
     return i1
 
+  def parse_pcdata_fast(self, x, i0):
+    n = len(x)
+    search_special = SPECIAL_CHAR0.search
+    match_tag = FAST_TAG.match
+    handle_characters = self.handle_characters
+    while i0 < n:
+      m = search_special(x, i0)
+      self.charpos = i0
+      if not m:
+        handle_characters(x[i0:])
+        return -1
+      i1 = m.start(0)
+      if i0 < i1:
+        handle_characters(x[i0:i1])
+      self.charpos = i1
+      if x[i1] == '&':
+        m = FAST_ENTITY.match(x, i1)
+        if not m:
+          self.feed_entity = self.handle_characters
+          self.parse0 = self.parse_pcdata
+          self.parse1 = self.parse_entity_0
+          return i1
+        handle_characters(self.handle_entity(m.group(1)))
+        i0 = m.end(0)
+        continue
+      m = match_tag(x, i1)
+      if m:
+        (end, name, attrstr) = m.group(1, 2, 3)
+        attrs = []
+        if attrstr:
+          for m1 in FAST_ATTRS.finditer(attrstr):
+            (attr, dq, sq, v) = m1.groups()
+            attr = attr.lower()
+            if dq is not None: v = dq
+            elif sq is not None: v = sq
+            elif v is None: v = attr
+            attrs.append((attr, v))
+        # kept as the state machine would, the end of CDATA uses them.
+        self.tag_name = name = name.lower()
+        self.tag_attrs = attrs
+        if end:
+          self.handle_end_tag(name, attrs)
+        else:
+          self.handle_start_tag(name, attrs) # this may change self.parse1 (CDATA).
+        i0 = m.end(0)
+        if self.parse1 != self.parse_pcdata:
+          return i0
+        continue
+      m = FAST_COMMENT.match(x, i1)
+      if m:
+        self.handle_start_tag('comment', {})
+        handle_characters(m.group(1))
+        self.handle_end_tag('comment', {})
+        i0 = m.end(0)
+        continue
+      m = FAST_DECL.match(x, i1)
+      if m:
+        self.handle_decl(m.group(1))
+        i0 = m.end(0)
+        continue
+      self.parse1 = self.parse_tag_0
+      return i1
+    return i0
+
   # this is called manually by a subclass
   def start_cdata(self, endname):
     self.cdata_endstr = '</'+endname
@@ -312,6 +312,43 @@ class Style(object):
   def set_border_bottom(self, args): self.set_border(args, ('bottom',))
 
 
+##  LookupCache
+##
+##  Keeps roughly the maxsize most recently used entries in two
+##  generations: entries are added to the recent one, and when it is
+##  full it replaces the old one. Entries found in the old one are
+##  moved back to the recent one.
+##
+class LookupCache:
+
+  def __init__(self, maxsize=10000):
+    self.maxsize = maxsize
+    self.clear()
+    return
+
+  def clear(self):
+    self.recent = {}
+    self.old = {}
+    return
+
+  def get(self, k):
+    try:
+      return self.recent[k]
+    except KeyError:
+      pass
+    v = self.old.get(k)
+    if v is not None:
+      self.put(k, v)
+    return v
+
+  def put(self, k, v):
+    self.recent[k] = v
+    if self.maxsize//2 <= len(self.recent):
+      self.old = self.recent
+      self.recent = {}
+    return
+
+
 ##  StyleSheet
 ##
 class StyleSheet:
@@ -321,6 +358,10 @@ class StyleSheet:
     self.state = {}
     self.device = device
     self.enabled = True
+    # lookups repeat across the pages of a site so they are cached here.
+    # cleared when a declaration is added.
+    self.cache = LookupCache()
+    self.index = None
     return
 
   def dup(self):
@@ -333,6 +374,8 @@ class StyleSheet:
     self.state = stylesheet.state.copy()
     self.device = stylesheet.device
     self.enabled = stylesheet.enabled
+    self.cache = LookupCache(stylesheet.cache.maxsize)
+    self.index = None
     return
   
   def parse(self, s, charset=None):
@@ -383,6 +426,9 @@ class StyleSheet:
 
   def add_decl(self, decl, selectors):
     if not self.enabled: return
+    # pages of a site often repeat the same <style>, which doesn't
+    # need the cached lookups thrown away.
+    changed = False
     for sel in selectors:
       k = (None, None)
       context = ''
@@ -394,25 +440,62 @@ class StyleSheet:
           tag = ''
         if context and (k not in self.state):
           self.state[k] = 1
+          changed = True
         k = (context,tag)
         context += '/'+tag
       if k in self.style:
-        self.style[k].update(decl)
+        old = self.style[k]
+        if not changed and [ p for (p,v) in decl.iteritems() if old.get(p) != v ]:
+          changed = True
+        old.update(decl)
       else:
         self.style[k] = decl
-    return
-
+        changed = True
+    if changed:
+      self.cache.clear()
+      self.index = None
+    return
+
+  # index: tag -> contexts that have a declaration or a state for it.
+  def get_index(self):
+    if self.index is None:
+      self.index = {}
+      for (c,t) in self.style.keys() + self.state.keys():
+        self.index.setdefault(t, set()).add(c)
+    return self.index
+
+  # Returns (style, contexts). Results are shared between lookups
+  # of the same tags and contexts so they must not be changed.
   def lookup(self, tags, contexts=None):
+    if not contexts:
+      k = (tuple(tags), None, None)
+    else:
+      (contexts0, contexts1) = contexts
+      k = (tuple(tags), frozenset(contexts0), frozenset(contexts1))
+    r = self.cache.get(k)
+    if r is None:
+      r = self.resolve(tags, contexts)
+      self.cache.put(k, r)
+    return r
+
+  def resolve(self, tags, contexts=None):
     if not contexts:
       contexts1 = ['']
       contexts2 = set(contexts1)
     else:
       (contexts0, contexts1) = contexts
-      contexts2 = contexts0.union(contexts1)
+      contexts2 = set(contexts0).union(contexts1)
+    # only contexts with something for one of the tags need looking at.
+    index = self.get_index()
+    relevant = set()
+    for t in tags:
+      if t in index:
+        relevant.update(index[t])
     dic = {}
     new = set()
     #print 'Lookup: (%s|%s>) + (%s)' % (','.join(contexts2), ','.join(contexts1), ','.join(tags)),
     for c in list(contexts2):
+      if c not in relevant: continue
       for t in tags:
         if (c,t) in self.style:
           dic.update(self.style[(c,t)])
@@ -422,6 +505,7 @@ class StyleSheet:
           new.add(c+'/'+t)
     for c in contexts1:
       c += '>'
+      if c not in relevant: continue
       for t in tags:
         if (c,t) in self.style:
           dic.update(self.style[(c,t)])
@@ -434,7 +518,7 @@ class StyleSheet:
     if dic:
       style = Style()
       style.add_decl(dic)
-    return (style, (contexts2, new))
+    return (style, (frozenset(contexts2), frozenset(new)))
 
 
 ##  CSSTokenizer